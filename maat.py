@@ -17,27 +17,49 @@
 #	You should have received a copy of the GNU General Public License
 #	along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-"""Main module of Maat, a python-based build system."""
+"""Main module of Maat, a python-based build system.
+
+As Maat is often called for small goals, its fixed startup cost
+matters: only the modules needed by any run are imported here, the other
+ones (maker, daemon, caches, etc.) are imported when the options or the
+build need them."""
+
+import time
+START = time.perf_counter()
 
 import argparse
+import hashlib
+import importlib.util
+import marshal
 import os.path
 import re
 import sys
-import traceback
 
 import maat.common as common
 import maat.io as io
-import maat.make
 import maat.rule
-from maat.builtin import *
-from maat import *
+from maat import builtin
+from maat import VERSION
+
+IMPORTED = time.perf_counter()
 
 
 rule_re = re.compile("^([ \t]*)(.*):(.*)$")
 indent_re = re.compile("^([ \t]*).*$")
+await_re = re.compile(r"\bawait\b")
+subdir_re = re.compile(r"""^[ \t]*subdir\([ \t]*(["'])([^"']*)\1[ \t]*\)""", re.M)
+
+# minimal size of the scripts to compile to use a pool of processes
+POOL_SIZE = 1 << 16
 
 # Command variables
 SCRIPTS = {}
+RULES = []
+FUNS = []
+BOUND = []
+POOLED = {}
+SCANNED = {}
+binding = False
 make_name = "make.maat"
 monitor = io.Monitor()
 DB = maat.rule.DataBase()
@@ -55,7 +77,8 @@ def maat_paths(paths):
 VARS_MAP = {
 	'@': '" + maat_path(maat_rule.targets[0]) + "',
 	'<': '" + maat_path(maat_rule.sources[0]) + "',
-	'^': '" + maat_paths(maat_rule.sources) + "'
+	'^': '" + maat_paths(maat_rule.sources) + "',
+	'*': '" + maat_rule.stem + "'
 }
 
 VAR_RE = re.compile(r"\$([^(])|\$\(([^)]+)\)")
@@ -79,27 +102,72 @@ def expand(text):
 
 # API variables
 TOPDIR = common.topdir
+API = {
+	"VERSION": VERSION,
+	"TOPDIR": TOPDIR,
+	"maat_path": maat_path,
+	"maat_paths": maat_paths
+}
 
 # parsing the script
 class Script:
 	"""Class in charge of parsing and running the script in order to
-	build the rule database."""
+	build the rule database. dir is the directory of the script
+	relatively to the top directory ("" for the top script): the paths
+	of its rules are relative to this directory."""
 
-	def __init__(self, path, env):
+	def __init__(self, path, env, dir = ""):
 		self.path = path
 		self.env = dict(env)
+		self.dir = dir
 		self.linefix = []
+		self.origin = None
+		self.load_time = 0.
+		self.run_time = 0.
 		SCRIPTS[path] = self
 
+	def resolve(self, path):
+		"""Get the path, relative to the directory of the script, as
+		relative to the top directory."""
+		if not self.dir or os.path.isabs(path):
+			return path
+		return os.path.normpath(os.path.join(self.dir, path))
+
+	def subdir(self, dir):
+		"""Include the script of the given sub-directory: its rules are
+		added to the same database, their paths being relative to the
+		sub-directory."""
+		dir = self.resolve(str(dir))
+		path = os.path.join(dir, make_name)
+		if not os.access(path, os.R_OK):
+			monitor.print_fatal("cannot access %s" % path)
+		start = time.perf_counter()
+		Script(path, self.env, dir).eval(monitor)
+		self.run_time -= time.perf_counter() - start
+
 	def make_rule(self, targets, sources, fun, file, line, cnum):
 		global first_goal
-		rule = maat.rule.FunRule(targets, sources, fun)
+		self.linefix.append(cnum)
+		FUNS.append(fun)
+		targets = [self.resolve(t) for t in targets]
+		sources = [self.resolve(s) for s in sources]
+		if binding:
+			BOUND.append((tuple(targets), tuple(sources)))
+			return
+		if [t for t in targets if "%" in t]:
+			rule = maat.rule.PatternRule(targets, sources, fun)
+			DB.add_pattern(rule)
+		else:
+			rule = maat.rule.FunRule(targets, sources, fun)
+			DB.add(rule)
+			if first_goal == None and not self.dir:
+				first_goal = targets[0]
 		rule.file = file
 		rule.line = line
-		DB.add(rule)
-		if first_goal == None:
-			first_goal = targets[0]
-		self.linefix.append(cnum)
+		rule.res = getattr(fun, "maat_resources", None)
+		if getattr(fun, "maat_process", False):
+			DB.process = True
+		RULES.append(rule)
 
 	def fix_line(self, line):
 		print(line, self.linefix)
@@ -109,9 +177,12 @@ class Script:
 			line -= 1
 		return line
 
-	def eval(self, mon):
-		"""Process the script to build the database. In case of error,
-		raise MaatError."""
+	def translate(self, text):
+		"""Translate the text of the script into Python source. Each rule
+		function gets its own name as the compiler takes a quadratic time
+		to merge many code objects only differing by their line. A rule
+		whose body awaits (await expression, async for or async with)
+		gets an asynchronous function."""
 
 		# prepare state machine
 		num = 0
@@ -122,50 +193,212 @@ class Script:
 		targets = None
 		sources = None
 		rnum = 0
-		source = ""
+		rdef = 0
+		awaits = False
+		source = []
 
-		# generate rule build line
+		# generate rule build line, making the function asynchronous if
+		# its body really awaits (and not only contains "await")
 		def make(f):
-			source = ""
+			if awaits and is_async(source[rdef:]):
+				source[rdef] = "%sasync def %s(maat_rule):\n" % (indent, f)
+			line = ""
 			if num - rnum <= 1:
-				source = source + indent + "\tpass\n"
-			return source + "self.make_rule([%s], [%s], %s, \"%s\", %s, %s)\n" %(
+				line = indent + "\tpass\n"
+			return line + "self.make_rule([%s], [%s], %s, \"%s\", %s, %s)\n" %(
 				", ".join(['"%s"' % t for t in targets]),
 				", ".join(['"%s"' % s for s in sources]),
 				f, self.path, rnum + 1, num
 			)
 
 		# process the lines
-		for l in open(path):
+		for l in text.splitlines(True):
 			num = num + 1
 			if mode == NORMAL:
 				m = rule_re.match(l)
 				if m == None:
-					source = source + l
+					source.append(l)
 				else:
 					mode = INRULE
 					rnum = num
 					indent = m.group(1)
 					targets = m.group(2).split()
 					sources = m.group(3).split()
-					source = source + indent + "def f(maat_rule):\n"
+					rdef = len(source)
+					awaits = False
+					source.append(indent + "def f_%d(maat_rule):\n" % num)
 			else:
 				m = indent_re.match(l)
 				if len(m.group(1)) <= len(indent):
 					mode = NORMAL
-					source += make("f")
+					source.append(make("f_%d" % rnum))
 				else:
 					l = expand(l)
-				source = source + l
+					if await_re.search(l):
+						awaits = True
+				source.append(l)
 
 		# final rule make if any
 		if mode == INRULE:
-			source += make("f")
+			source.append(make("f_%d" % rnum))
+		return "".join(source)
+
+	def get_code(self):
+		"""Get the code object of the script. The compiled code is
+		cached in the work directory, keyed by the script path, its
+		content hash and Maat version, so that an unchanged script is
+		neither translated nor compiled again."""
+		with open(self.path, "rb") as file:
+			text = file.read()
+		cache, header = get_cache(self.path, text)
+
+		# look in the cache
+		try:
+			with open(cache, "rb") as file:
+				data = file.read()
+			if data.startswith(header):
+				self.origin = "cached"
+				return marshal.loads(data[len(header):])
+		except (OSError, EOFError, ValueError, TypeError):
+			pass
 
-		# process the new sources
+		# translate, compile and store in the cache
+		self.origin = "compiled"
+		source = self.translate(text.decode())
 		#print("DEBUG:", source)
 		code = compile(source, self.path, "exec")
-		exec(code, globals(), locals())
+		try:
+			with open(cache + ".tmp", "wb") as file:
+				file.write(header)
+				marshal.dump(code, file)
+			os.replace(cache + ".tmp", cache)
+		except OSError:
+			pass
+		return code
+
+	def get_namespace(self):
+		"""Build the namespace the script is executed in: the public
+		built-in functions, the API variables, the directory of the
+		script (DIR) and the subdir() function."""
+		ns = {n: v for n, v in vars(builtin).items() if not n.startswith("_")}
+		ns.update(self.env)
+		ns["self"] = self
+		ns["DIR"] = common.Path(self.dir or ".")
+		ns["subdir"] = self.subdir
+		return ns
+
+	def eval(self, mon):
+		"""Process the script to build the database. In case of error,
+		raise MaatError."""
+		start = time.perf_counter()
+		code = self.get_code()
+		self.load_time = time.perf_counter() - start
+		exec(code, self.get_namespace())
+		self.run_time += time.perf_counter() - start - self.load_time
+
+	def get_timings(self):
+		"""Get the timings of the script as a string."""
+		origin = self.origin
+		if self.path in POOLED:
+			origin = "compiled in pool %.1fms" % (POOLED[self.path] * 1000)
+		return "%s: load %.1fms (%s), run %.1fms" % (self.path,
+			self.load_time * 1000, origin, self.run_time * 1000)
+
+
+def is_async(lines):
+	"""Test if the function, given by its source lines, contains await
+	expressions, async for or async with statements, outside of nested
+	functions. The text is only looked for them, hence comments and
+	strings are ignored."""
+	import ast
+	import textwrap
+	text = textwrap.dedent("".join(lines))
+	try:
+		tree = ast.parse("async " + text)
+	except SyntaxError:
+		return False
+	stack = list(tree.body[0].body)
+	while stack:
+		node = stack.pop()
+		if isinstance(node, (ast.Await, ast.AsyncFor, ast.AsyncWith)):
+			return True
+		if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef,
+		ast.Lambda, ast.ClassDef)):
+			stack.extend(ast.iter_child_nodes(node))
+	return False
+
+
+def get_cache(path, text):
+	"""Get the path of the cached compiled script of the given path and
+	the header it must start with for the given script text."""
+	header = importlib.util.MAGIC_NUMBER \
+		+ ("maat-%s\n" % VERSION).encode() \
+		+ hashlib.blake2b(text, digest_size=16).digest()
+	name = hashlib.blake2b(os.path.abspath(path).encode(),
+		digest_size=8).hexdigest()
+	return common.work_path("script-%s.pyc" % name), header
+
+
+def compile_script(path):
+	"""Translate and compile the script in the compiled script cache.
+	Called in the processes of the pool. Return the time spent."""
+	start = time.perf_counter()
+	Script(path, API).get_code()
+	return time.perf_counter() - start
+
+
+def precompile():
+	"""Translate and compile in parallel the scripts that are not in the
+	compiled script cache. The scripts are found by following the calls
+	to subdir() with a literal argument. The pool of processes is only
+	used if there are several processors, several scripts and enough
+	text to compile to compensate its startup; otherwise, as for the
+	scripts not found, the scripts are compiled when they are run. In
+	any case, the scripts are run in order by this process so that the
+	rules are defined in a deterministic order."""
+	stale = []
+	size = 0
+	todo = [("", make_name)]
+	seen = set()
+	while todo:
+		dir, path = todo.pop()
+		if path in seen:
+			continue
+		seen.add(path)
+		try:
+			with open(path, "rb") as file:
+				text = file.read()
+		except OSError:
+			continue
+		cache, header = get_cache(path, text)
+		try:
+			with open(cache, "rb") as file:
+				valid = file.read(len(header)) == header
+		except OSError:
+			valid = False
+		if not valid:
+			stale.append(path)
+			size += len(text)
+		for m in subdir_re.finditer(text.decode(errors="replace")):
+			sub = os.path.normpath(os.path.join(dir, m.group(2)))
+			todo.append((sub, os.path.join(sub, make_name)))
+	try:
+		cpus = len(os.sched_getaffinity(0))
+	except AttributeError:
+		cpus = os.cpu_count() or 1
+	if len(stale) < 2 or size < POOL_SIZE or cpus < 2:
+		return
+	import concurrent.futures
+	import multiprocessing
+	try:
+		context = multiprocessing.get_context("fork")
+		with concurrent.futures.ProcessPoolExecutor(min(len(stale), cpus),
+		mp_context=context) as pool:
+			for path, duration in zip(stale, pool.map(compile_script, stale)):
+				POOLED[path] = duration
+	except Exception:
+		# errors are reported when the scripts are compiled again
+		pass
 
 
 # parse arguments
@@ -177,30 +410,234 @@ parser.add_argument('goals', nargs='*',
 	help="Goals to make.")
 parser.add_argument('--print-data-base', '-p', action="store_true",
 	help="Print the rule database.")
-args = parser.parse_args()
-path = make_name
+parser.add_argument('--jobs', '-j', type=int, nargs='?', default=1,
+	const=os.cpu_count(),
+	help="Number of jobs to run in parallel (number of processors if no value).")
+parser.add_argument('--async', dest="use_async", action="store_true",
+	help="Run the jobs, up to the number given by -j, in an asyncio event loop.")
+parser.add_argument('--mem', metavar="GB", type=float,
+	help="Memory budget of the parallel jobs (default physical memory).")
+parser.add_argument('--load-average', '-l', metavar="LOAD", type=float, nargs='?',
+	const=os.cpu_count(),
+	help="Start no job while the load average exceeds LOAD (number of processors if no value).")
+parser.add_argument('--adaptive', action="store_true",
+	help="Adapt the number of parallel jobs to the load average and the available memory.")
+parser.add_argument('--jobserver-style', choices=["pipe", "fifo"], default="pipe",
+	help="Kind of GNU make jobserver given to the commands with -j (default pipe, fifo needs GNU make 4.4).")
+parser.add_argument('--progress', action="store_true",
+	help="Write the output from a separate thread with a progress line (periodic progress messages if not on a terminal).")
+parser.add_argument('--dry-run', '--explain', '-n', action="store_true",
+	help="Display the rules to make with the reason, without making them.")
+parser.add_argument('--sign', '-s', action="store_true",
+	help="Use content signatures instead of dates to find rules to update.")
+parser.add_argument('--stats', action="store_true",
+	help="Display statistics at the end of the build.")
+parser.add_argument('--profile', action="store_true",
+	help="Display the time of the build phases and the slowest rules.")
+parser.add_argument('--trace', metavar="FILE",
+	help="Write the build profile as Chrome trace events in FILE.")
+parser.add_argument('--cache', action="store_true",
+	help="Restore the targets from the build output cache when possible.")
+parser.add_argument('--cache-dir', metavar="DIR",
+	help="Directory of the build output cache (default .maat/cache).")
+parser.add_argument('--cache-size', metavar="MB", type=int, default=1024,
+	help="Maximum size of the build output cache in MB (default 1024).")
+parser.add_argument('--cache-env', metavar="NAMES", action="append", default=[],
+	help="Comma-separated environment variables changing the commands, added to the cache key (in addition to PATH, CC, CFLAGS, etc.).")
+parser.add_argument('--remote-cache', metavar="URL",
+	help="URL of a remote build output cache shared with other machines (implies --cache).")
+parser.add_argument('--daemon', action="store_true",
+	help="Run as a build server keeping the rule database in memory.")
+parser.add_argument('--client', '-c', action="store_true",
+	help="Ask the build server to build (build locally if no server runs).")
+parser.add_argument('--no-snapshot', action="store_true",
+	help="Always run the script instead of loading the saved rule graph.")
+parser.add_argument('--startup-profile', action="store_true",
+	help="Display the time spent in imports and parsing before the build.")
 
 
-# parse the script
-if not os.access(path, os.R_OK):
-	monitor.print_fatal("cannot access %s" % path)
-main_script = Script(path, locals())
-main_script.eval(monitor)
+# persistent data
+history = None
+signs = None
 
+def load_stores(args):
+	"""Load the persistent data needed by the arguments, if not already
+	done."""
+	global history, signs
+	import maat.deps
+	import maat.trace
+	if history is None:
+		history = maat.trace.History()
+		history.load()
+	if maat.deps.DB is None:
+		maat.deps.DB = maat.deps.DepDB()
+		maat.deps.DB.load()
+	if args.remote_cache:
+		args.cache = True
+	if (args.sign or args.cache) and signs is None:
+		import maat.sign
+		signs = maat.sign.SignDB()
+		signs.load()
 
-# print the data base
-if args.print_data_base:
-	for rule in DB.rules:
-		print(rule)
+	# the modules of the unused stores are not imported (see
+	# maat.rule.get_db()) but may have been used by a previous build
+	if args.sign:
+		maat.sign.DB = signs
+	elif "maat.sign" in sys.modules:
+		maat.sign.DB = None
+	if args.cache:
+		import maat.cache
+		path = args.cache_dir
+		if path is None:
+			path = common.work_path("cache")
+		env = []
+		for names in args.cache_env:
+			env += [name for name in names.split(",") if name]
+		maat.cache.DB = maat.cache.Cache(path, args.cache_size << 20, signs, env)
+		if args.remote_cache:
+			import maat.remote
+			maat.cache.DB.remote = maat.remote.RemoteCache(args.remote_cache, maat.cache.DB)
+	elif "maat.cache" in sys.modules:
+		maat.cache.DB = None
 
-# build the goals
-else:
+def save_stores():
+	"""Save the persistent data."""
+	history.save()
+	maat.deps.DB.save()
+	if signs is not None:
+		signs.save()
+	cache = maat.rule.get_db("cache")
+	if cache is not None:
+		cache.close()
+
+
+def run_scripts():
+	"""Run the scripts, recording the defined rules, their functions and
+	the directories scanned by the scripts."""
+	global SCANNED
+	SCRIPTS.clear()
+	RULES.clear()
+	FUNS.clear()
+	BOUND.clear()
+	POOLED.clear()
+	common.DIRS.clear()
+	precompile()
+	Script(make_name, API).eval(monitor)
+	SCANNED = dict(common.DIRS.stamps)
+
+
+def bind_rules():
+	"""Run the scripts only to get the functions of the rules loaded from
+	a snapshot, with their targets and sources to check they are the
+	rules of the snapshot."""
+	global binding
+	binding = True
+	try:
+		run_scripts()
+	finally:
+		binding = False
+	return list(FUNS), list(BOUND)
+
+
+def load_script():
+	"""Build the rule database from the snapshot of the rule graph if the
+	scripts did not change, by running the scripts else."""
+	global DB, first_goal, SCANNED
+	if not os.access(make_name, os.R_OK):
+		monitor.print_fatal("cannot access %s" % make_name)
+	snap = None
+	if not args.no_snapshot:
+		from maat import snapshot
+		snap = snapshot.Snapshot(make_name, bind_rules)
+		loaded = snap.load()
+		if loaded is not None:
+			DB, first_goal, SCANNED = loaded
+			SCRIPTS.clear()
+			Script(make_name, API)
+			return
+	DB = maat.rule.DataBase()
+	first_goal = None
+	run_scripts()
+	if first_goal is None and DB.rules:
+		first_goal = DB.rules[0].targets[0]
+	if snap is not None:
+		snap.save(list(SCRIPTS), SCANNED, RULES, first_goal)
+	RULES.clear()
+
+
+def build(args, prof = None, buffered = False):
+	"""Build the goals of the arguments. Return the exit status."""
+	import maat.make
+	from maat import pool
+	pool.DB = DB
 	goals = args.goals
 	if goals == []:
 		goals = [first_goal]
+
+	# share the jobs with the tools run by the build
+	jobs = args.jobs
+	js = None
+	if not args.dry_run and (jobs > 1 or "--jobserver" in os.environ.get("MAKEFLAGS", "")):
+		from maat import jobserver
+		try:
+			js = jobserver.connect()
+		except OSError as e:
+			monitor.print_warning("cannot use the jobserver of MAKEFLAGS: %s" % e)
+		if js is not None:
+			if jobs == 1:
+				jobs = js.jobs or os.cpu_count()
+		elif jobs > 1:
+			js = jobserver.create(jobs, args.jobserver_style)
+
+	if args.use_async:
+		maker = maat.make.AsyncMaker(DB, jobs)
+	elif jobs > 1:
+		maker = maat.make.ParMaker(DB, jobs)
+	else:
+		maker = maat.make.SeqMaker(DB)
+		maker.buffered = buffered
+	if jobs > 1:
+		maker.budget.mem = args.mem
+		maker.budget.load = args.load_average
+		maker.budget.adaptive = args.adaptive or args.load_average is not None
+	maker.prof = prof
+	maker.jobserver = js
+	load_stores(args)
+	maker.history = history
+	mon = monitor
+	if args.progress and not args.dry_run:
+		# the output of the jobs must be buffered to keep it with their
+		# command lines
+		mon = io.BufferedMonitor()
+		maker.buffered = True
+	start = common.time()
+	calls, saved = common.STATS.calls, common.STATS.saved
 	try:
-		maat.make.SeqMaker(DB).make(goals, monitor)
+		try:
+			if args.dry_run:
+				maker.explain(goals, mon)
+			elif not maker.make(goals, mon):
+				return 1
+		finally:
+			pool.close()
+			if js is not None:
+				js.close()
+			save_stores()
+			if args.stats:
+				mon.print_info("stat cache: %d calls, %d saved"
+					% (common.STATS.calls - calls, common.STATS.saved - saved))
+			cache = maat.rule.get_db("cache")
+			if cache is not None:
+				cache.report(mon)
+			if prof is not None:
+				prof.add("build", maat.trace.PHASE, start, common.time() - start)
+				if args.profile:
+					prof.summarize(mon)
+				if args.trace:
+					prof.write_trace(args.trace)
+			mon.close()
 	except Exception as e:
+		import traceback
 		error_re = re.compile(r'^\s*File "([^"]*)", line ([0-9]+), in')
 		for f in traceback.format_tb(sys.exc_info()[2]):
 			m = error_re.match(f)
@@ -210,3 +647,79 @@ else:
 			except KeyError:
 				print(f)
 		print("%s: %s" % (e.__class__.__name__, e))
+		return 1
+	return 0
+
+
+def print_data_base():
+	"""Print the rule database."""
+	for rule in DB.rules:
+		print(rule)
+	for rule in DB.patterns:
+		print(rule)
+
+
+def serve_request(argv):
+	"""Handle a build request received by the daemon."""
+	args = parser.parse_args(argv)
+	if args.print_data_base:
+		print_data_base()
+		return 0
+	prof = None
+	if args.profile or args.trace:
+		import maat.trace
+		prof = maat.trace.Profiler()
+	return build(args, prof, True)
+
+
+def print_startup(steps):
+	"""Display the startup timings: steps is the list of pairs (name,
+	date) ending each startup step."""
+	last = START
+	times = []
+	for name, date in steps:
+		times.append("%s %.1fms" % (name, (date - last) * 1000))
+		last = date
+	monitor.print_info("startup: %s, total %.1fms (%d modules loaded)"
+		% (", ".join(times), (last - START) * 1000, len(sys.modules)))
+	for script in SCRIPTS.values():
+		if script.origin is not None:
+			monitor.print_info("  " + script.get_timings())
+
+
+args = parser.parse_args()
+steps = [("imports", IMPORTED), ("arguments", time.perf_counter())]
+
+# forward to the daemon
+if args.client:
+	import maat.daemon
+	status = maat.daemon.request([a for a in sys.argv[1:] if a not in ("-c", "--client")])
+	if status is not None:
+		sys.exit(status)
+
+# parse the script
+prof = None
+if args.profile or args.trace:
+	import maat.trace
+	prof = maat.trace.Profiler()
+start = common.time()
+load_script()
+if prof is not None:
+	prof.add("parse", maat.trace.PHASE, start, common.time() - start)
+steps.append(("script", time.perf_counter()))
+if args.startup_profile:
+	print_startup(steps)
+
+# run as daemon
+if args.daemon:
+	import maat.daemon
+	maat.daemon.Server(serve_request, lambda: list(SCRIPTS), load_script,
+		lambda: common.DIRS.changed(SCANNED)).serve()
+
+# print the data base
+elif args.print_data_base:
+	print_data_base()
+
+# build the goals
+else:
+	sys.exit(build(args, prof))
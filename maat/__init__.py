@@ -16,3 +16,5 @@
 #	along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 """Main module of Maat, a python-based build system."""
+
+VERSION = "2.0"
@@ -0,0 +1,155 @@
+#	MAAT resource budget of the jobs
+#	Copyright (C) 2022 H. Casse <hug.casse@gmail.com>
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Resource budget of the jobs run in parallel. The resources used by
+a rule are given by the resources() decorator of its action as a
+triple (CPU slots, memory in GB, exclusive pool name or None), the
+default being one slot. A job is started only if the resources it needs
+are available: the slots (the number of jobs, -j), the memory budget
+(the physical memory by default) and its pool, if any, that is used by
+at most one job at a time. A job is always started if no other job
+runs, even if it exceeds the budget.
+
+In adaptive mode, a job is also not started while the load average
+exceeds the given limit or the memory available in the system (Linux
+only) is too low for it."""
+
+import os
+import time
+
+DEFAULT = (1, 0., None)
+
+# minimal ratio of the physical memory that must remain available
+RESERVE = 0.05
+
+# delay, in seconds, between two reads of the system state
+PERIOD = 0.5
+
+
+def get_total_memory():
+	"""Get the physical memory in GB, None if it is unknown."""
+	try:
+		return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / (1 << 30)
+	except (ValueError, OSError, AttributeError):
+		return None
+
+
+def get_available_memory():
+	"""Get the memory available without swapping in GB, None if it is
+	unknown."""
+	try:
+		with open("/proc/meminfo") as file:
+			for line in file:
+				if line.startswith("MemAvailable:"):
+					return int(line.split()[1]) / (1 << 20)
+	except (OSError, ValueError, IndexError):
+		pass
+	return None
+
+
+class Budget:
+	"""Budget of resources for cpu slots and mem GB of memory (physical
+	memory if None). load is the limit of the load average in adaptive
+	mode."""
+
+	def __init__(self, cpu, mem = None):
+		self.cpu = cpu
+		self.mem = mem
+		self.load = None
+		self.adaptive = False
+		self.used_cpu = 0
+		self.used_mem = 0.
+		self.pools = set()
+		self.running = 0
+		self.stamp = 0.
+		self.loadavg = 0.
+		self.available = None
+		self.total = None
+
+	def start(self):
+		"""Prepare the budget for a build."""
+		if self.mem is None or self.adaptive:
+			self.total = get_total_memory()
+		if self.mem is None:
+			self.mem = self.total if self.total is not None else float("inf")
+		if self.adaptive and self.load is None:
+			self.load = float(os.cpu_count() or 1)
+
+	def get_poll(self):
+		"""Get the delay to wait before checking again the budget when a
+		job cannot be started (None to wait for a job to end)."""
+		return PERIOD if self.adaptive else None
+
+	def update(self):
+		"""Read the system state, at most once per period."""
+		now = time.monotonic()
+		if now - self.stamp >= PERIOD:
+			self.stamp = now
+			try:
+				self.loadavg = os.getloadavg()[0]
+			except OSError:
+				self.loadavg = 0.
+			self.available = get_available_memory()
+
+	def full(self):
+		"""Test if no more job can be started, whatever its resources."""
+		if self.running == 0:
+			return False
+		if self.used_cpu >= self.cpu:
+			return True
+		if self.adaptive:
+			self.update()
+			if self.loadavg >= self.load:
+				return True
+			if self.available is not None and self.total is not None \
+			and self.available < self.total * RESERVE:
+				return True
+		return False
+
+	def fits(self, rule):
+		"""Test if the job of the rule can be started."""
+		cpu, mem, pool = rule.res or DEFAULT
+		if pool is not None and pool in self.pools:
+			return False
+		if self.running == 0:
+			return True
+		if self.used_cpu + cpu > self.cpu or self.used_mem + mem > self.mem:
+			return False
+		if self.adaptive and mem and self.available is not None \
+		and mem > self.available:
+			return False
+		return True
+
+	def take(self, rule):
+		"""Record the resources used by the started job of the rule."""
+		cpu, mem, pool = rule.res or DEFAULT
+		self.used_cpu += cpu
+		self.used_mem += mem
+		if pool is not None:
+			self.pools.add(pool)
+		self.running += 1
+
+		# the memory of the job is not yet used
+		if self.available is not None:
+			self.available -= mem
+
+	def give(self, rule):
+		"""Release the resources of the ended job of the rule."""
+		cpu, mem, pool = rule.res or DEFAULT
+		self.used_cpu -= cpu
+		self.used_mem -= mem
+		self.pools.discard(pool)
+		self.running -= 1
@@ -20,6 +20,8 @@ import re
 
 import os.path
 
+import maat.common as common
+
 # state
 MON = None
 
@@ -29,8 +31,60 @@ join = os.path.join
 
 
 def shell(cmd):
-	"""Implements the shell(...) function"""
+	"""Implements the shell(...) function: run the command and raise
+	a MaatError if it fails."""
+	from maat import process
+	MON.print_info(cmd)
+	status = process.run(cmd)
+	if status != 0:
+		common.error("command failed with status %d: %s" % (status, cmd))
+
+
+async def ashell(cmd):
+	"""Implements the ashell(...) function, to be awaited in asynchronous
+	rule bodies: run the command without blocking the other actions and
+	raise a MaatError if it fails."""
+	from maat import process
 	MON.print_info(cmd)
+	status = await process.run_async(cmd)
+	if status != 0:
+		common.error("command failed with status %d: %s" % (status, cmd))
+
+
+def in_process(fun):
+	"""Decorator marking a rule whose action is performed in a worker
+	process, for CPU-bound Python actions that would be serialized by
+	the GIL:
+
+	@in_process
+	table.c: gen.py
+		...
+	"""
+	fun.maat_process = True
+	return fun
+
+
+def resources(cpu = 1, mem = 0, pool = None):
+	"""Decorator giving the resources used by the action of a rule: the
+	number of job slots (counted in -j), the memory in GB and the name
+	of an exclusive pool (only one job of a pool runs at a time):
+
+	@resources(mem=8, pool="link")
+	main: $(OBJECTS)
+		...
+	"""
+	def decorate(fun):
+		fun.maat_resources = (cpu, float(mem), pool)
+		return fun
+	return decorate
+
+
+def glob(pattern):
+	"""Get the sorted list of the paths matching the pattern, relative
+	to the top directory. The pattern may contain "*", "?", "[...]" and,
+	as a component, "**" to match any number of sub-directories. The
+	directory contents are cached for the whole run."""
+	return common.DIRS.glob(pattern)
 
 
 def echo(*args):
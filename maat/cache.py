@@ -0,0 +1,359 @@
+#	MAAT build output cache
+#	Copyright (C) 2022 H. Casse <hug.casse@gmail.com>
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Local cache of build outputs. When a rule is made, its targets are
+stored in a content-addressed directory under a key computed from the
+signature of its action, the contents of its sources (including the
+discovered dependencies), the current directory and the environment
+variables that may change the commands (KEY_ENV and --cache-env).
+The next time the rule has to be made with the same key, the targets
+are restored, by hard link or by copy, instead of running the action.
+The objects are private copies of the targets and their content is
+checked before they are restored: a file written in place through a
+hard link made by a restore only causes a cache miss.
+
+The cache directory contains the objects (files named by the hash of
+their content, in sub-directories named by the 2 first digits) and the
+entries (files named by the key, containing the list of targets with
+their object hash and mode, and the discovered dependencies, or, for
+manifests, only the discovered dependencies). The objects are
+touched when used and, when the cache exceeds its size, the least
+recently used objects are removed."""
+
+import hashlib
+import marshal
+import os
+import shutil
+import threading
+
+import maat.common as common
+from maat import deps
+from maat import sign
+
+# build output cache (None if not used)
+DB = None
+
+# environment variables that may change the result of a command
+KEY_ENV = [
+	"AR", "AS", "CC", "CFLAGS", "CPP", "CPPFLAGS", "CXX", "CXXFLAGS",
+	"LC_ALL", "LD", "LDFLAGS", "LDLIBS", "MAKEFLAGS", "PATH",
+	"PKG_CONFIG_PATH", "SOURCE_DATE_EPOCH"
+]
+
+
+def hash_env(names):
+	"""Hash the current directory, relative to the top directory, and
+	the given environment variables. Only the variables that may change
+	the result of a command are hashed so that the same project in
+	another directory or on another machine gets the same keys."""
+	h = hashlib.blake2b(digest_size=16)
+	h.update(os.path.relpath(os.getcwd(), common.topdir).encode())
+	for name in sorted(set(names)):
+		value = os.environ.get(name)
+		if value is None:
+			continue
+		if name == "MAKEFLAGS":
+			# the jobserver changes at each run and, once exported,
+			# leaves an empty MAKEFLAGS that must match an unset one
+			from maat import jobserver
+			value = jobserver.clean_flags(value)
+			if not value:
+				continue
+		h.update(("\0%s=%s" % (name, value)).encode())
+	return h.digest()
+
+
+class Cache:
+	"""Build output cache in the directory path, bounded to size bytes.
+	signs is used to get the hashes of the files. env gives the names of
+	environment variables to add to the key in addition to KEY_ENV."""
+
+	def __init__(self, path, size, signs, env = ()):
+		self.path = path
+		self.size = size
+		self.signs = signs
+		self.env = hash_env(KEY_ENV + list(env))
+		self.hits = 0
+		self.misses = 0
+		self.saved = 0
+		self.lock = threading.Lock()
+		self.remote = None
+		for dir in ("objects", "entries"):
+			os.makedirs(os.path.join(path, dir), exist_ok=True)
+		try:
+			with open(os.path.join(path, "size")) as file:
+				self.total = int(file.read())
+		except (OSError, ValueError):
+			self.total = 0
+
+	def get_object(self, digest):
+		"""Get the path of an object."""
+		name = digest.hex()
+		return os.path.join(self.path, "objects", name[:2], name[2:])
+
+	def get_entry(self, key):
+		"""Get the path of an entry."""
+		return os.path.join(self.path, "entries", key.hex())
+
+	def read_entry(self, file):
+		"""Read an entry from the file and return the pair (targets,
+		discovered dependencies). targets is a list of triples (target,
+		object hash, mode) or None if the entry is a manifest. Raise
+		ValueError if the entry is malformed, as it may come from the
+		remote cache."""
+		targets, discovered = marshal.load(file)
+		if targets is not None:
+			targets = [(t, d, m) for t, d, m in targets]
+			for t, d, m in targets:
+				if not isinstance(t, str) or not isinstance(d, bytes) \
+				or len(d) != 16 or not isinstance(m, int):
+					raise ValueError("bad cache entry")
+		return targets, discovered
+
+	def write_entry(self, key, targets, discovered):
+		"""Write an entry."""
+		path = self.get_entry(key)
+		tmp = "%s.%d.tmp" % (path, threading.get_ident())
+		with open(tmp, "wb") as file:
+			marshal.dump((targets, discovered), file)
+		os.replace(tmp, path)
+
+	def add_object(self, path, obj):
+		"""Move the file path to the object obj."""
+		os.replace(path, obj)
+		with self.lock:
+			self.total += os.path.getsize(obj)
+
+	def hash_files(self, h, paths):
+		"""Add the names and the contents of the files to the hash.
+		Return False if a file is missing."""
+		for path in paths:
+			digest = self.signs.digest(path)
+			if digest is None:
+				return False
+			h.update(("\0" + path + "\0").encode())
+			h.update(digest)
+		return True
+
+	def key(self, rule):
+		"""Compute the base key of the rule, from its declared sources.
+		Return None if a source is missing.
+
+		As the discovered dependencies may be unknown (for example, in
+		a fresh work directory), the entry of the base key is a manifest
+		giving the discovered dependencies when there are some. The
+		entry of the targets is then found at the key extending the
+		base key with the discovered dependencies."""
+		h = hashlib.blake2b(self.env + rule.signature(), digest_size=16)
+		for target in rule.targets:
+			h.update(("\0" + target).encode())
+		if not self.hash_files(h, rule.sources):
+			return None
+		return h.digest()
+
+	def extend_key(self, key, discovered):
+		"""Extend a base key with the discovered dependencies. Return
+		None if one of them is missing."""
+		h = hashlib.blake2b(key, digest_size=16)
+		if not self.hash_files(h, discovered):
+			return None
+		return h.digest()
+
+	def lookup(self, key):
+		"""Look for the entry of the base key, following the manifest
+		if any. Return the pair (key, entry) or None."""
+		try:
+			with open(self.get_entry(key), "rb") as file:
+				entry = self.read_entry(file)
+			if entry[0] is None:
+				key = self.extend_key(key, entry[1])
+				if key is None:
+					return None
+				with open(self.get_entry(key), "rb") as file:
+					entry = self.read_entry(file)
+			return key, entry
+		except (OSError, EOFError, ValueError, TypeError):
+			return None
+
+	def restore(self, rule):
+		"""Restore the targets of the rule from the cache. Return True
+		if the targets have been restored, False else. Only the targets
+		of the rule are written: an entry giving other ones, corrupted
+		or received from a bad remote cache, is a miss."""
+		key = self.key(rule)
+		found = None
+		if key is not None:
+			found = self.lookup(key)
+			if found is None and self.remote is not None and self.remote.wait(rule):
+				found = self.lookup(key)
+		if found is None:
+			with self.lock:
+				self.misses += 1
+			return False
+		key, (targets, discovered) = found
+		if [t for t, _, _ in targets] != list(rule.targets):
+			with self.lock:
+				self.misses += 1
+			return False
+		size = 0
+		try:
+			os.utime(self.get_entry(key))
+			for target, (_, digest, mode) in zip(rule.targets, targets):
+				obj = self.get_object(digest)
+
+				# a file written through a hard link of the object
+				# changed it: the object is dropped
+				if sign.hash_file(obj) != digest:
+					os.remove(obj)
+					raise OSError()
+				os.utime(obj)
+				dir = os.path.dirname(target)
+				if dir:
+					os.makedirs(dir, exist_ok=True)
+				tmp = target + ".maat-tmp"
+				try:
+					if os.stat(obj).st_mode & 0o7777 != mode:
+						raise OSError()
+					os.link(obj, tmp)
+				except OSError:
+					shutil.copyfile(obj, tmp)
+					os.chmod(tmp, mode)
+				os.replace(tmp, target)
+				common.STATS.invalidate(target)
+				common.DIRS.invalidate(dir)
+				size += os.path.getsize(target)
+		except OSError:
+			with self.lock:
+				self.misses += 1
+			return False
+		if deps.DB is not None:
+			deps.DB.set(rule, discovered)
+		with self.lock:
+			self.hits += 1
+			self.saved += size
+		return True
+
+	def unshare(self, rule):
+		"""Remove the targets of the rule that are hard links to the
+		cache objects so that the action does not modify the cache
+		when it writes its targets."""
+		for target in rule.targets:
+			st = common.STATS.stat(target)
+			if st is not None and st.st_nlink > 1:
+				try:
+					os.remove(target)
+				except OSError:
+					pass
+				common.STATS.invalidate(target)
+
+	def store(self, rule):
+		"""Store the targets of a rule that has just been made."""
+		key = self.key(rule)
+		if key is None:
+			return
+		discovered = deps.DB.get(rule) if deps.DB is not None else []
+		keys = [key]
+		targets = []
+		added = 0
+		try:
+			if discovered:
+				self.write_entry(key, None, discovered)
+				key = self.extend_key(key, discovered)
+				if key is None:
+					return
+				keys.append(key)
+			for target in rule.targets:
+				digest = self.signs.digest(target)
+				if digest is None:
+					return
+				obj = self.get_object(digest)
+				if not os.path.exists(obj):
+					os.makedirs(os.path.dirname(obj), exist_ok=True)
+					tmp = "%s.%d.tmp" % (obj, threading.get_ident())
+					shutil.copyfile(target, tmp)
+					os.chmod(tmp, common.STATS.stat(target).st_mode & 0o7777)
+					os.replace(tmp, obj)
+					added += os.path.getsize(obj)
+				mode = common.STATS.stat(target).st_mode & 0o7777
+				targets.append((target, digest, mode))
+			self.write_entry(key, targets, discovered)
+		except OSError:
+			return
+		with self.lock:
+			self.total += added
+		if self.remote is not None:
+			self.remote.push(keys, targets)
+
+	def save(self):
+		"""Save the size of the cache."""
+		path = os.path.join(self.path, "size")
+		with open(path + ".tmp", "w") as file:
+			file.write(str(self.total))
+		os.replace(path + ".tmp", path)
+
+	def evict(self):
+		"""Remove the least recently used objects, and the entries
+		older than them, until the cache size is under 3/4 of its bound.
+		The cache size is only computed exactly when its estimation
+		exceeds the bound."""
+		if self.total <= self.size:
+			self.save()
+			return
+		objects = []
+		total = 0
+		root = os.path.join(self.path, "objects")
+		for dir in os.scandir(root):
+			for obj in os.scandir(dir.path):
+				st = obj.stat()
+				objects.append((st.st_mtime, st.st_size, obj.path))
+				total += st.st_size
+		objects.sort()
+		limit = 0
+		for date, size, path in objects:
+			if total <= self.size * 3 // 4:
+				break
+			os.remove(path)
+			total -= size
+			limit = date
+		for entry in os.scandir(os.path.join(self.path, "entries")):
+			if entry.stat().st_mtime <= limit:
+				os.remove(entry.path)
+		self.total = total
+		self.save()
+
+	def prefetch(self, rules):
+		"""Start fetching from the remote cache the given rules whose
+		sources are up to date."""
+		if self.remote is not None:
+			for rule in rules:
+				self.remote.prefetch(rule)
+
+	def close(self):
+		"""Finish the pending transfers with the remote cache and evict
+		the least recently used objects if needed."""
+		if self.remote is not None:
+			self.remote.close()
+		self.evict()
+
+	def report(self, mon):
+		"""Display the statistics of the cache."""
+		count = self.hits + self.misses
+		if count:
+			mon.print_info("cache: %d hits, %d misses (%d%% hits), %d KB saved"
+				% (self.hits, self.misses, self.hits * 100 // count,
+				self.saved // 1024))
+		if self.remote is not None and self.remote.errors:
+			mon.print_warning("remote cache: %d transfer errors" % self.remote.errors)
@@ -17,8 +17,11 @@
 """This module provides several facilities useful for other modules."""
 
 import fnmatch
+import marshal
 import os
+import re
 import sys
+import threading
 import time as pytime
 
 import maat.io
@@ -47,6 +50,185 @@ def error(msg):
 	raise MaatError(msg)
 
 
+# file status cache
+class StatCache:
+	"""Cache of file status shared by the whole build: each path is
+	stat'ed at most once until it is invalidated, typically when a rule
+	writes its targets. Counts the performed stat() calls and the saved
+	ones."""
+
+	def __init__(self):
+		self.map = {}
+		self.calls = 0
+		self.saved = 0
+
+	def stat(self, path):
+		"""Get the status of the given path or None if it does not
+		exist."""
+		try:
+			st = self.map[path]
+			self.saved += 1
+			return st
+		except KeyError:
+			pass
+		self.calls += 1
+		try:
+			st = os.stat(path)
+		except OSError:
+			st = None
+		self.map[path] = st
+		return st
+
+	def exists(self, path):
+		"""Test if the given path exists."""
+		return self.stat(path) is not None
+
+	def get_mod_time(self, path):
+		"""Get the modification time of the path. Raise OSError if it
+		does not exist."""
+		st = self.stat(path)
+		if st is None:
+			raise FileNotFoundError(path)
+		return st.st_mtime
+
+	def invalidate(self, path):
+		"""Remove the status of the given path from the cache."""
+		self.map.pop(path, None)
+
+	def clear(self):
+		"""Remove all the status from the cache."""
+		self.map = {}
+
+STATS = StatCache()
+
+
+# directory index
+MAGIC_CHARS = set("*?[")
+
+class DirCache:
+	"""Cache of the directory contents shared by the whole build: each
+	directory is scanned at most once, with os.scandir(), until it is
+	invalidated. The scanned directories are recorded with their
+	modification date (in stamps) so that the files added or removed
+	since can be detected without scanning again."""
+
+	def __init__(self):
+		self.map = {}
+		self.stamps = {}
+		self.scans = 0
+		self.saved = 0
+
+	def list(self, dir):
+		"""Get the sorted list of the pairs (name, is directory) of the
+		entries of the given directory ("" for the current directory).
+		Return an empty list if it is not a directory."""
+		dir = os.path.normpath(dir or os.curdir)
+		try:
+			entries = self.map[dir]
+			self.saved += 1
+			return entries
+		except KeyError:
+			pass
+		self.scans += 1
+		entries = []
+		try:
+			self.stamps[dir] = os.stat(dir).st_mtime_ns
+			with os.scandir(dir) as it:
+				for entry in it:
+					try:
+						entries.append((entry.name, entry.is_dir()))
+					except OSError:
+						pass
+		except OSError:
+			self.stamps[dir] = None
+		entries.sort()
+		self.map[dir] = entries
+		return entries
+
+	def walk(self, dir):
+		"""Generate the directory and its sub-directories, recursively,
+		except the hidden ones."""
+		todo = [dir]
+		while todo:
+			dir = todo.pop()
+			yield dir
+			subs = [os.path.join(dir, name)
+				for name, is_dir in self.list(dir) if is_dir and name[0] != "."]
+			todo.extend(reversed(subs))
+
+	def glob(self, pattern):
+		"""Get the sorted list of the paths matching the pattern. As for
+		glob.glob(), the components of the pattern may contain "*", "?"
+		and "[...]", hidden files are only matched by components starting
+		with ".", and the component "**" matches any number of
+		sub-directories (including none). A pattern ending with a
+		separator only matches directories, returned with a trailing
+		separator. Repeated separators are merged."""
+		pattern = str(pattern)
+		if os.path.isabs(pattern):
+			dirs = [os.sep]
+			pattern = pattern.lstrip(os.sep)
+		else:
+			dirs = [""]
+		comps = [c for c in pattern.split(os.sep) if c]
+		trailing = pattern.endswith(os.sep)
+		for i, comp in enumerate(comps):
+			last = i == len(comps) - 1 and not trailing
+			res = []
+			if comp == "**":
+				for dir in dirs:
+					if last and dir:
+						res.append(os.path.join(dir, ""))
+					for d in self.walk(dir):
+						if not last:
+							res.append(d)
+						else:
+							res.extend([os.path.join(d, name)
+								for name, _ in self.list(d) if name[0] != "."])
+			elif comp in (os.curdir, os.pardir):
+				res = [os.path.join(dir, comp) for dir in dirs]
+			elif MAGIC_CHARS.isdisjoint(comp):
+				for dir in dirs:
+					for name, is_dir in self.list(dir):
+						if name == comp and (last or is_dir):
+							res.append(os.path.join(dir, name))
+			else:
+				match = re.compile(fnmatch.translate(comp)).match
+				hidden = comp[0] == "."
+				for dir in dirs:
+					for name, is_dir in self.list(dir):
+						if (last or is_dir) and (hidden or name[0] != ".") \
+						and match(name):
+							res.append(os.path.join(dir, name))
+			dirs = res
+		if trailing:
+			dirs = [os.path.join(d, "") for d in dirs if d]
+		return sorted(set(dirs)) if comps else []
+
+	def changed(self, stamps):
+		"""Test if one of the directories of stamps (as recorded in the
+		stamps attribute) has been modified."""
+		for dir, stamp in stamps.items():
+			try:
+				if os.stat(dir).st_mtime_ns != stamp:
+					return True
+			except OSError:
+				if stamp is not None:
+					return True
+		return False
+
+	def invalidate(self, dir):
+		"""Remove the contents of the given directory from the cache."""
+		self.map.pop(os.path.normpath(dir or os.curdir), None)
+
+	def clear(self):
+		"""Remove all the directory contents from the cache."""
+		self.map = {}
+		self.stamps = {}
+
+DIRS = DirCache()
+
+
 #def script_error(msg):
 #	"""Exit and display script error."""
 #	global script_failed
@@ -60,13 +242,13 @@ class Path:
 	"""Base class of objects representing files.
 	Mainly defined by its path. Provide several facilities like "/"
 	overload."""
-	path = None
-	
+	__slots__ = ("path",)
+
 	def __init__(self, path):
 		if isinstance(path, Path):
 			self.path = path.path
 		else:
-			self.path = str(path)
+			self.path = sys.intern(str(path))
 	
 	def __truediv__(self, arg):
 		return Path(os.path.join(self.path, str(arg)))
@@ -82,10 +264,10 @@ class Path:
 	
 	def exists(self):
 		"""Test if the file matching the path exists."""
-		return os.path.exists(self.path)
+		return STATS.exists(self.path)
 
 	def get_mod_time(self):
-		return os.path.getmtime(self.path)
+		return STATS.get_mod_time(self.path)
 		
 	def prefixed_by(self, path):
 		return self.path.startswith(str(path))
@@ -120,7 +302,8 @@ class Path:
 		return Path(os.path.dirname(self.path))
 	
 	def glob(self, re = "*"):
-		return glob.glob(os.path.join(self.path, re))
+		"""Get the paths matching the pattern in this directory."""
+		return DIRS.glob(os.path.join(self.path, re))
 
 	def get_ext(self):
 		"""Get extension of a path."""
@@ -138,10 +321,10 @@ class Path:
 		return self.parent() / (pref + self.get_base().get_file() + suff)
 
 	def __iter__(self):
+		"""Iterate on the names of the entries of the directory."""
 		if not self.is_dir():
-			script_error("%s is not a directory" % self.path)
-		else:
-			return iter([Path(p) for p in os.listdir(self.path)])
+			error("%s is not a directory" % self.path)
+		return iter([Path(name) for name, _ in DIRS.list(self.path)])
 
 	def makedir(self):
 		"""Build a directory corresponding to the current path. If needed,
@@ -349,6 +532,58 @@ class FunDelegate(Delegate):
 		self.fun()
 
 
+# persistent data
+WORK_DIR = ".maat"
+
+def work_path(name):
+	"""Get the path of a file in the work directory of Maat, that is,
+	the directory where persistent data are stored between runs.
+	The work directory is created if needed."""
+	path = os.path.join(topdir, WORK_DIR)
+	if not os.path.isdir(path):
+		os.makedirs(path)
+	return os.path.join(path, name)
+
+
+class Store:
+	"""Data persistent between runs stored in a file of the work
+	directory. The data is saved with marshal and must be made only
+	of marshallable types."""
+
+	def __init__(self, name):
+		self.name = name
+		self.data = self.default()
+		self.modified = False
+		self.lock = threading.Lock()
+
+	def default(self):
+		"""Build the data when the store does not exist or cannot be
+		loaded."""
+		return {}
+
+	def load(self):
+		"""Load the data from the work directory. If the store
+		cannot be read, use the default data."""
+		try:
+			with open(work_path(self.name), "rb") as file:
+				data = marshal.load(file)
+			if type(data) == type(self.data):
+				self.data = data
+		except (OSError, EOFError, ValueError, TypeError):
+			pass
+		self.modified = False
+
+	def save(self):
+		"""Save the data in the work directory if they have been
+		modified."""
+		if self.modified:
+			path = work_path(self.name)
+			with open(path + ".tmp", "wb") as file:
+				marshal.dump(self.data, file)
+			os.replace(path + ".tmp", path)
+			self.modified = False
+
+
 # post-initializatioon list
 post_inits = []		# Processing to call just before building
 
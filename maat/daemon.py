@@ -0,0 +1,340 @@
+#	MAAT build daemon
+#	Copyright (C) 2022 H. Casse <hug.casse@gmail.com>
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Build daemon: a long-lived server keeping the rule database and the
+file status cache in memory between builds. Build requests are received
+from thin clients on a Unix socket of the work directory. The file
+status cache is kept up to date by watching the directories with
+inotify (on Linux); without inotify, it is cleared before each build.
+
+A request is a JSON line containing the command line arguments, the
+current directory and the environment of the client. The build runs
+in this environment, so that the commands and the cache keys get the
+variables of the client; the scripts are run again when it is not the
+environment they were run in. The answer is a sequence of
+frames made of a channel byte (OUT, ERR or EXIT), a 4-byte big-endian
+length and the data: output text for OUT and ERR, exit status in
+decimal for EXIT."""
+
+import ctypes
+import ctypes.util
+import io as pyio
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+
+import maat.common as common
+
+SOCKET = "daemon.sock"
+
+EXIT = 0
+OUT = 1
+ERR = 2
+
+FRAME = struct.Struct(">BI")
+
+# inotify constants
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM \
+	| IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT = struct.Struct("iIII")
+
+
+class Watcher:
+	"""Watch directories with Linux inotify. Raise OSError if inotify
+	is not available."""
+
+	def __init__(self):
+		name = ctypes.util.find_library("c")
+		self.libc = ctypes.CDLL(name, use_errno=True)
+		if not hasattr(self.libc, "inotify_init1"):
+			raise OSError("inotify is not available")
+		self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), "inotify_init1")
+		self.wds = {}
+		self.dirs = set()
+
+	def watch(self, dir):
+		"""Watch the given directory ("" for the current directory).
+		Return True if the directory was not already watched."""
+		if dir in self.dirs:
+			return False
+		self.dirs.add(dir)
+		wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir or "."), IN_MASK)
+		if wd >= 0:
+			self.wds.setdefault(wd, set()).add(dir)
+		return True
+
+	def read(self):
+		"""Read the pending events and return the list of modified paths,
+		or None if some events have been lost, or a watched directory
+		is removed, and any path must be considered as modified."""
+		paths = []
+		while True:
+			try:
+				buf = os.read(self.fd, 65536)
+			except BlockingIOError:
+				return paths
+			i = 0
+			while i < len(buf):
+				wd, mask, _, size = EVENT.unpack_from(buf, i)
+				name = os.fsdecode(buf[i + EVENT.size:i + EVENT.size + size].rstrip(b"\0"))
+				i += EVENT.size + size
+				if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF):
+					paths = None
+				if mask & IN_IGNORED:
+					self.dirs -= self.wds.pop(wd, set())
+				elif paths is not None:
+					for dir in self.wds.get(wd, ()):
+						paths.append(os.path.join(dir, name))
+
+
+class FrameWriter(pyio.RawIOBase):
+	"""Raw stream sending the written data as frames of the given
+	channel. Once the client is disconnected, the data is dropped."""
+
+	def __init__(self, sock, channel):
+		self.sock = sock
+		self.channel = channel
+
+	def writable(self):
+		return True
+
+	def write(self, data):
+		if self.sock is not None:
+			try:
+				self.sock.sendall(FRAME.pack(self.channel, len(data)) + bytes(data))
+			except OSError:
+				self.sock = None
+		return len(data)
+
+
+def open_stream(sock, channel):
+	"""Build a text stream sending frames on the given channel."""
+	return pyio.TextIOWrapper(pyio.BufferedWriter(FrameWriter(sock, channel)),
+		write_through=True)
+
+
+class Server:
+	"""Build server. handler is called with the arguments of each
+	request and must return the exit status. script_paths returns the
+	paths of the scripts and reload is called when one of them changed
+	since the last build, or when outdated, if given, returns True (for
+	example when a directory scanned by the scripts changed)."""
+
+	def __init__(self, handler, script_paths, reload, outdated = None):
+		self.handler = handler
+		self.script_paths = script_paths
+		self.reload = reload
+		self.outdated = outdated
+		self.stamps = {}
+		self.base = dict(os.environ)
+		self.env = self.base
+		try:
+			self.watcher = Watcher()
+		except OSError:
+			self.watcher = None
+
+	def get_stamps(self):
+		"""Get the stat() information of the scripts."""
+		stamps = {}
+		for path in self.script_paths():
+			try:
+				st = os.stat(path)
+				stamps[path] = (st.st_mtime_ns, st.st_size, st.st_ino)
+			except OSError:
+				stamps[path] = None
+		return stamps
+
+	def update(self):
+		"""Invalidate the status of the modified files, and the contents
+		of their directories, before a build. Return True if the scripts
+		must be run again."""
+		paths = None
+		if self.watcher is not None:
+			paths = self.watcher.read()
+		if paths is None:
+			common.STATS.clear()
+			common.DIRS.clear()
+		else:
+			for path in paths:
+				common.STATS.invalidate(path)
+				common.DIRS.invalidate(os.path.dirname(path))
+		stamps = self.get_stamps()
+		if stamps != self.stamps:
+			self.stamps = stamps
+			return True
+		return self.outdated is not None and self.outdated()
+
+	def watch(self):
+		"""Watch the directories of the paths in the file status cache.
+		The status of the paths of newly watched directories are
+		removed as they may have changed before the watch started."""
+		if self.watcher is None:
+			return
+		for path in self.script_paths():
+			self.watcher.watch(os.path.dirname(path))
+		new = set()
+		for path in list(common.STATS.map):
+			dir = os.path.dirname(path)
+			if self.watcher.watch(dir):
+				new.add(dir)
+		for dir in list(common.DIRS.map):
+			dir = "" if dir == os.curdir else dir
+			if self.watcher.watch(dir):
+				new.add(dir)
+		if new:
+			for path in list(common.STATS.map):
+				if os.path.dirname(path) in new:
+					common.STATS.invalidate(path)
+			for dir in new:
+				common.DIRS.invalidate(dir)
+
+	def handle(self, conn):
+		"""Handle a request."""
+		data = b""
+		while not data.endswith(b"\n"):
+			buf = conn.recv(4096)
+			if not buf:
+				return
+			data += buf
+		request = json.loads(data.decode())
+		out = open_stream(conn, OUT)
+		err = open_stream(conn, ERR)
+		old_out, old_err = sys.stdout, sys.stderr
+		sys.stdout, sys.stderr = out, err
+		env = request.get("env", self.base)
+		set_environ(env)
+		try:
+			if os.path.realpath(request["cwd"]) != os.path.realpath(common.topdir):
+				err.write("ERROR: the daemon serves %s\n" % common.topdir)
+				status = 1
+			else:
+				if self.update() or env != self.env:
+					try:
+						self.reload()
+						self.env = env
+					except:
+						self.stamps = {}
+						raise
+				status = self.handler(request["argv"])
+		except SystemExit as e:
+			status = e.code if isinstance(e.code, int) else 1
+		except Exception as e:
+			err.write("ERROR: %s\n" % e)
+			status = 1
+		finally:
+			out.flush()
+			err.flush()
+			sys.stdout, sys.stderr = old_out, old_err
+			set_environ(self.base)
+		self.watch()
+		try:
+			conn.sendall(FRAME.pack(EXIT, len(str(status))) + str(status).encode())
+		except OSError:
+			pass
+
+	def serve(self):
+		"""Run the server until interrupted."""
+		self.stamps = self.get_stamps()
+		self.watch()
+		path = common.work_path(SOCKET)
+		if os.path.exists(path):
+			os.remove(path)
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		sock.bind(path)
+		sock.listen(16)
+		signal.signal(signal.SIGTERM, lambda n, f: sys.exit(0))
+		try:
+			while True:
+				conn, _ = sock.accept()
+				with conn:
+					self.handle(conn)
+		except (KeyboardInterrupt, SystemExit):
+			pass
+		finally:
+			sock.close()
+			os.remove(path)
+
+
+def set_environ(env):
+	"""Replace the environment of the process by the given one."""
+	if env != os.environ:
+		os.environ.clear()
+		os.environ.update(env)
+
+
+def get_environ():
+	"""Get the environment to send with a request. The pipe of a
+	jobserver given in MAKEFLAGS cannot be used by the daemon and is
+	removed (a fifo can)."""
+	env = dict(os.environ)
+	flags = env.get("MAKEFLAGS", "")
+	if "--jobserver" in flags and "fifo:" not in flags:
+		from maat import jobserver
+		env["MAKEFLAGS"] = jobserver.clean_flags(flags)
+	return env
+
+
+def recv_all(sock, size):
+	"""Receive exactly size bytes. Raise EOFError if the connection is
+	closed before."""
+	data = b""
+	while len(data) < size:
+		buf = sock.recv(size - len(data))
+		if not buf:
+			raise EOFError()
+		data += buf
+	return data
+
+
+def request(argv):
+	"""Send a build request to the daemon and display its output.
+	Return the exit status or None if no daemon is running."""
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		sock.connect(os.path.join(common.topdir, common.WORK_DIR, SOCKET))
+	except OSError:
+		sock.close()
+		return None
+	with sock:
+		sock.sendall((json.dumps({"argv": argv, "cwd": os.getcwd(),
+			"env": get_environ()}) + "\n").encode())
+		streams = {OUT: sys.stdout.buffer, ERR: sys.stderr.buffer}
+		try:
+			while True:
+				channel, size = FRAME.unpack(recv_all(sock, FRAME.size))
+				data = recv_all(sock, size)
+				if channel == EXIT:
+					return int(data)
+				streams[channel].write(data)
+				streams[channel].flush()
+		except EOFError:
+			return 1
@@ -0,0 +1,101 @@
+#	MAAT discovered dependencies
+#	Copyright (C) 2022 H. Casse <hug.casse@gmail.com>
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Dependencies discovered when a rule is made, typically the headers
+included by a C source as reported by the compiler in a depfile
+(options -MD or -MMD of GCC and Clang). After a rule is made, the
+depfile named by the rule (attribute depfile) or, by default, the file
+with extension .d named after each target, if it has just been written,
+is parsed and its prerequisites are stored in the work directory. They
+are used as additional sources to decide if the rule needs update."""
+
+import os.path
+import re
+
+import maat.common as common
+
+TOKEN_RE = re.compile(r"(?:\\.|[^\s\\])+")
+ESCAPE_RE = re.compile(r"\\(.)")
+
+# discovered dependencies database
+DB = None
+
+
+def parse_depfile(path):
+	"""Parse a make-style depfile and return the list of its
+	prerequisites."""
+	with open(path) as file:
+		text = file.read().replace("\\\n", " ")
+	deps = []
+	for line in text.splitlines():
+		i = line.find(": ")
+		if i < 0:
+			if not line.endswith(":"):
+				continue
+			i = len(line) - 1
+		for token in TOKEN_RE.findall(line[i + 1:]):
+			dep = ESCAPE_RE.sub(r"\1", token).replace("$$", "$")
+			if dep not in deps:
+				deps.append(dep)
+	return deps
+
+
+class DepDB(common.Store):
+	"""Database of the discovered dependencies: for each rule, identified
+	by its first target, the list of dependencies read from its depfile
+	the last time it was made."""
+
+	def __init__(self):
+		common.Store.__init__(self, "deps")
+
+	def get(self, rule):
+		"""Get the discovered dependencies of the rule."""
+		return self.data.get(rule.targets[0], [])
+
+	def set(self, rule, deps):
+		"""Set the discovered dependencies of the rule."""
+		key = rule.targets[0]
+		with self.lock:
+			if deps:
+				if self.data.get(key) != deps:
+					self.data[key] = deps
+					self.modified = True
+			elif key in self.data:
+				del self.data[key]
+				self.modified = True
+
+	def get_depfiles(self, rule):
+		"""Get the possible depfiles of the rule."""
+		if rule.depfile is not None:
+			return [str(rule.depfile)]
+		else:
+			return [os.path.splitext(t)[0] + ".d" for t in rule.targets]
+
+	def update(self, rule, start):
+		"""Update the dependencies of a rule made from date start with
+		the depfiles written since then."""
+		deps = []
+		for path in self.get_depfiles(rule):
+			if path in rule.targets:
+				continue
+			common.STATS.invalidate(path)
+			st = common.STATS.stat(path)
+			if st is not None and st.st_mtime >= start - 1:
+				for dep in parse_depfile(path):
+					if dep not in deps and dep not in rule.sources \
+					and dep not in rule.targets:
+						deps.append(dep)
+		self.set(rule, deps)
@@ -15,7 +15,13 @@
 #	along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 """Input/output management module for Maat tool."""
+import contextvars
+import queue
+import re
+import shutil
 import sys
+import threading
+import time
 
 # ANSI coloration
 NORMAL = "\033[0m"
@@ -72,6 +78,109 @@ BACK_WHITE = "\033[47m"
 
 #null_stream = NullStream()
 
+# job output
+LOCK = threading.Lock()
+"""Lock ensuring that outputs do not interleave."""
+OUTPUT = contextvars.ContextVar("output", default=None)
+"""Output of the current job, local to the current thread or asyncio
+task."""
+WRITER = None
+"""Buffered monitor the job outputs are written by, if any."""
+BLOCK_SIZE = 1 << 16
+"""Size of the blocks job outputs are copied by."""
+
+def new_buffer():
+	"""Create an anonymous temporary file to buffer an output. tempfile
+	is only imported when needed as most runs do not buffer outputs."""
+	import tempfile
+	return tempfile.TemporaryFile()
+
+
+class Output:
+	"""Buffers for the standard output and error of a job running
+	concurrently with other jobs. The content is stored in anonymous
+	temporary files, created at first use, so that large outputs are not
+	kept in memory."""
+
+	def __init__(self):
+		self.out = None
+		self.err = None
+
+	def get_out(self):
+		"""Get the file buffering the standard output."""
+		if self.out is None:
+			self.out = new_buffer()
+		return self.out
+
+	def get_err(self):
+		"""Get the file buffering the standard error."""
+		if self.err is None:
+			self.err = new_buffer()
+		return self.err
+
+	def write_out(self, text):
+		self.get_out().write(text.encode())
+
+	def write_err(self, text):
+		self.get_err().write(text.encode())
+
+	def flush(self):
+		"""Flush the buffers, to be done before giving them to
+		a sub-process."""
+		for file in (self.out, self.err):
+			if file is not None:
+				file.flush()
+
+	def read(self):
+		"""Get the buffered standard output and error as a pair of bytes
+		and release the buffers."""
+		res = []
+		for file in (self.out, self.err):
+			if file is None:
+				res.append(b"")
+			else:
+				file.seek(0)
+				res.append(file.read())
+				file.close()
+		self.out = self.err = None
+		return tuple(res)
+
+	def dump(self):
+		"""Copy the buffered content to the standard error and output
+		and release the buffers. With a buffered monitor, the buffers
+		are given to its writer thread."""
+		if WRITER is not None:
+			for file in (self.out, self.err):
+				if file is not None:
+					file.flush()
+					file.seek(0)
+			WRITER.put_files(self.err, self.out)
+			self.out = None
+			self.err = None
+			return
+		with LOCK:
+			for file, stream in ((self.err, sys.stderr), (self.out, sys.stdout)):
+				if file is not None:
+					file.flush()
+					file.seek(0)
+					stream.flush()
+					shutil.copyfileobj(file, stream.buffer)
+					stream.buffer.flush()
+					file.close()
+		self.out = None
+		self.err = None
+
+
+def get_output():
+	"""Get the output of the job run by the current thread or task, None
+	if the output is not buffered."""
+	return OUTPUT.get()
+
+def set_output(output):
+	"""Set the output of the job run by the current thread or task."""
+	OUTPUT.set(output)
+
+
 class Monitor:
 	"""A context is used to configure the execution of an action."""
 	out = sys.stdout
@@ -80,69 +189,84 @@ class Monitor:
 	verbose = False
 	flushed = False
 	action = None
+
+	def write_err(self, text):
+		"""Write text to the standard error, or to the buffer of the
+		current job output if any."""
+		output = get_output()
+		if output is not None:
+			output.write_err(text)
+		else:
+			with LOCK:
+				sys.stderr.write(text)
+				sys.stderr.flush()
+
+	def write_out(self, text):
+		"""Write text to the standard output, or to the buffer of the
+		current job output if any."""
+		output = get_output()
+		if output is not None:
+			output.write_out(text)
+		else:
+			with LOCK:
+				sys.stdout.write(text)
+				sys.stdout.flush()
 	
 	def handle_action(self):
 		"""Manage a pending action display."""
 		if self.action and not self.flushed:
-			sys.stderr.write("\n")
+			self.write_err("\n")
 			self.flushed = True
 	
 	def print_command(self, cmd):
 		"""Print a command before running it."""
 		if not self.quiet and self.command_ena:
 			self.handle_action()
-			sys.stderr.write(CYAN + "> " + str(cmd) + NORMAL + "\n")
-			sys.stderr.flush()
+			self.write_err(CYAN + "> " + str(cmd) + NORMAL + "\n")
 	
 	def print_info(self, info):
 		"""Print information line about built target."""
 		if not self.quiet:
 			self.handle_action()
-			sys.stderr.write(BOLD + BLUE + str(info) + NORMAL + "\n")
-			sys.stderr.flush()
+			self.write_err(BOLD + BLUE + str(info) + NORMAL + "\n")
 
 	def print_error(self, msg):
 		"""Print an error message."""
 		if not self.quiet:
 			self.handle_action()
-			sys.stderr.write(BOLD + RED + "ERROR: " + str(msg) + NORMAL + "\n")
-			sys.stderr.flush()
+			self.write_err(BOLD + RED + "ERROR: " + str(msg) + NORMAL + "\n")
 	
 	def print_fatal(self, msg):
 		"""Print an error message."""
 		if not self.quiet:
-			sys.stderr.write(BOLD + RED + "ERROR: " + str(msg) + NORMAL + "\n")
+			self.write_err(BOLD + RED + "ERROR: " + str(msg) + NORMAL + "\n")
 			sys.exit(1)
 	
 	def print_warning(self, msg):
 		"""Print a warning message."""
 		if not self.quiet:
 			self.handle_action()
-			sys.stderr.write(BOLD + YELLOW + "WARNING: " + str(msg) + NORMAL + "\n")
-			sys.stderr.flush()
+			self.write_err(BOLD + YELLOW + "WARNING: " + str(msg) + NORMAL + "\n")
 
 	def print_success(self, msg):
 		"""Print a success message."""
 		if not self.quiet:
 			self.handle_action()
-			sys.stderr.write(BOLD + GREEN + "[100%] " + msg + str(NORMAL) + "\n")
-			sys.stderr.flush()
+			self.write_err(BOLD + GREEN + "[100%] " + msg + str(NORMAL) + "\n")
 
 	def print_action(self, msg):
 		"""Print a beginning action."""
 		if not self.quiet:
-			sys.stderr.write("%s ... " % msg)
-			sys.stderr.flush()
+			self.write_err("%s ... " % msg)
 			self.action = msg
 			self.flushed = False
 	
 	def print_final(self, msg):
 		if not self.quiet:
 			if self.flushed:
-				sys.stderr.write("%s ... " % self.action)				
-			sys.stderr.write(msg)
-			sys.stderr.write("\n");
-			sys.stderr.flush()
+				self.write_err("%s ... " % self.action)				
+			self.write_err(msg)
+			self.write_err("\n");
 			self.action = None
 			self.flushed = False
 	
@@ -161,8 +285,191 @@ class Monitor:
 	def print(self, msg):
 		if sys.stderr == sys.stdout:
 			self.handle_action()
-		sys.stdout.write(msg + "\n")
-		sys.stdout.flush()
+		self.write_out(msg + "\n")
+
+	def start_build(self, count):
+		"""Called when a build of count jobs starts."""
+		pass
+
+	def start_job(self, rule):
+		"""Called when the job of the rule starts."""
+		pass
+
+	def end_job(self, rule, success):
+		"""Called when the job of the rule ends."""
+		pass
+
+	def close(self):
+		"""Called at the end of the build to write the pending output."""
+		pass
+
+
+ESCAPE_RE = re.compile("\033\\[[0-9;]*m")
+ESCAPE_BYTES_RE = re.compile(b"\033\\[[0-9;]*m")
+
+class BufferedMonitor(Monitor):
+	"""Monitor writing the messages and the job outputs by batches from
+	a dedicated thread, so that the jobs never wait for the terminal.
+	On a terminal, a progress line, redrawn below the messages, displays
+	the number of jobs done, running and the estimated remaining time.
+	Else, the colors are removed and the progress is written as a line
+	every LOG_PERIOD seconds. The thread is only started with the build,
+	after the workers of the process pool, if any, are forked."""
+	TTY_PERIOD = .1
+	LOG_PERIOD = 10.
+
+	def __init__(self, tty = None):
+		global WRITER
+		self.tty = sys.stderr.isatty() if tty is None else tty
+		self.queue = queue.SimpleQueue()
+		self.lock = threading.Lock()
+		self.total = 0
+		self.done = 0
+		self.running = 0
+		self.start = None
+		self.line = ""
+		self.thread = threading.Thread(target=self.work)
+		self.thread.daemon = True
+		WRITER = self
+
+	def write_err(self, text):
+		output = get_output()
+		if output is not None:
+			output.write_err(text)
+		else:
+			self.queue.put((sys.stderr, text))
+
+	def write_out(self, text):
+		output = get_output()
+		if output is not None:
+			output.write_out(text)
+		else:
+			self.queue.put((sys.stdout, text))
+
+	def put_files(self, err, out):
+		"""Write the buffers, rewound, of a job output (None if there is
+		no output). They are closed once written."""
+		if err is not None:
+			self.queue.put((sys.stderr, err))
+		if out is not None:
+			self.queue.put((sys.stdout, out))
+
+	def copy(self, file, stream):
+		"""Copy a job output buffer to the stream by blocks, so that it
+		is never loaded in memory, and close it. Out of a terminal,
+		the escape sequences are removed: a sequence possibly cut at
+		the end of a block is kept for the next block."""
+		stream.flush()
+		rest = b""
+		block = file.read(BLOCK_SIZE)
+		while block:
+			if not self.tty:
+				block = rest + block
+				pos = block.rfind(b"\033")
+				if pos >= 0 and len(block) - pos < 32 and b"m" not in block[pos:]:
+					block, rest = block[:pos], block[pos:]
+				else:
+					rest = b""
+				block = ESCAPE_BYTES_RE.sub(b"", block)
+			stream.buffer.write(block)
+			block = file.read(BLOCK_SIZE)
+		stream.buffer.write(rest)
+		file.close()
+
+	def start_build(self, count):
+		with self.lock:
+			self.total += count
+			if self.start is None:
+				self.start = time.monotonic()
+				self.thread.start()
+
+	def start_job(self, rule):
+		with self.lock:
+			self.running += 1
+
+	def end_job(self, rule, success):
+		with self.lock:
+			self.running -= 1
+			self.done += 1
+
+	def get_progress(self):
+		"""Build the progress line."""
+		with self.lock:
+			total, done, running, start = self.total, self.done, self.running, self.start
+		width = len(str(total))
+		line = "[%*d/%d] %d running" % (width, done, total, running)
+		if done and done < total:
+			eta = int((time.monotonic() - start) * (total - done) / done)
+			line += ", ETA %d:%02d" % divmod(eta, 60)
+		return line
+
+	def write(self, items, progress):
+		"""Write a batch of items, updating the progress line if progress
+		is True."""
+		streams = []
+		for stream, data in items:
+			if isinstance(data, str):
+				if not self.tty:
+					data = ESCAPE_RE.sub("", data)
+				stream.write(data)
+			else:
+				self.copy(data, stream)
+			if stream not in streams:
+				streams.append(stream)
+		if progress and self.total:
+			line = self.get_progress()
+			if self.tty:
+				line = line[:shutil.get_terminal_size().columns - 1]
+				if line != self.line or items:
+					sys.stderr.write("\r" + line + "\033[K")
+					self.line = line
+				if sys.stderr not in streams:
+					streams.append(sys.stderr)
+			elif line != self.line:
+				sys.stderr.write(line + "\n")
+				self.line = line
+				if sys.stderr not in streams:
+					streams.append(sys.stderr)
+		for stream in streams:
+			stream.flush()
+
+	def work(self):
+		"""Writer thread."""
+		period = self.TTY_PERIOD if self.tty else self.LOG_PERIOD
+		next = time.monotonic() + period
+		stop = False
+		while not stop:
+			items = []
+			try:
+				items.append(self.queue.get(timeout=max(0., next - time.monotonic())))
+				while True:
+					items.append(self.queue.get_nowait())
+			except queue.Empty:
+				pass
+			if items and items[-1] is None:
+				items.pop()
+				stop = True
+			now = time.monotonic()
+			progress = now >= next
+			if progress:
+				next = now + period
+			with LOCK:
+				if items and self.tty and self.line:
+					sys.stderr.write("\r\033[K")
+					self.line = ""
+					progress = True
+				self.write(items, progress and not stop)
+
+	def close(self):
+		global WRITER
+		WRITER = None
+		if self.start is None:
+			self.thread.start()
+		self.queue.put(None)
+		self.thread.join()
+		if self.tty and self.line:
+			sys.stderr.write("\r\033[K")
+			sys.stderr.flush()
 		
 
 DEF = Monitor()		# better to remove it at some point
@@ -0,0 +1,164 @@
+#	MAAT GNU make jobserver
+#	Copyright (C) 2022 H. Casse <hug.casse@gmail.com>
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""GNU make jobserver, bounding the number of jobs run at once by all
+the build tools of a process tree (make, cargo, ninja, Maat, etc.).
+
+The jobserver is a pipe, or a named pipe (fifo), containing one byte,
+a token, per job that may run in addition to the first one: each
+process has an implicit token for its first job and reads a token from
+the pipe before starting any other job, writing it back once the job
+is done. The jobserver is given to the sub-processes in the MAKEFLAGS
+environment variable with option --jobserver-auth=R,W (file descriptors
+of the pipe, inherited) or --jobserver-auth=fifo:PATH.
+
+When Maat runs in parallel, it creates a jobserver for its commands,
+unless it is itself run by a tool providing a jobserver: it then takes
+its tokens from it."""
+
+import os
+import re
+import select
+import threading
+
+import maat.common as common
+from maat import process
+
+AUTH_RE = re.compile(r"(?:^|\s)--jobserver-(?:auth|fds)=(\S+)")
+JOBS_RE = re.compile(r"(?:^|\s)-j(\d*)(?=\s|$)")
+TOKEN = b"+"
+
+
+def clean_flags(flags):
+	"""Remove the jobserver and job count options from the flags."""
+	return " ".join(JOBS_RE.sub(" ", AUTH_RE.sub(" ", flags)).split())
+
+
+class JobServer:
+	"""Pool of tokens read from rfd and written back to wfd. auth is the
+	value of --jobserver-auth and jobs the total number of jobs, if
+	known."""
+
+	def __init__(self, rfd, wfd, auth, jobs = None):
+		self.rfd = rfd
+		self.wfd = wfd
+		self.auth = auth
+		self.jobs = jobs
+		self.implicit = True
+		self.lock = threading.Lock()
+		self.fds = []
+		self.path = None
+		self.exported = False
+		self.flags = None
+
+	def acquire(self):
+		"""Get a token, waiting for one if needed. Return the token to
+		pass to release()."""
+		with self.lock:
+			if self.implicit:
+				self.implicit = False
+				return None
+		while True:
+			try:
+				token = os.read(self.rfd, 1)
+			except BlockingIOError:
+				select.select([self.rfd], [], [])
+				continue
+			if not token:
+				common.error("jobserver closed")
+			return token
+
+	def release(self, token):
+		"""Give back a token got from acquire()."""
+		if token is None:
+			with self.lock:
+				self.implicit = True
+		else:
+			os.write(self.wfd, token)
+
+	def export(self):
+		"""Give the jobserver to the commands run by the build."""
+		self.exported = True
+		self.flags = os.environ.get("MAKEFLAGS")
+		flags = clean_flags(self.flags or "")
+		os.environ["MAKEFLAGS"] = ("%s -j%d --jobserver-auth=%s"
+			% (flags, self.jobs, self.auth)).strip()
+		if self.path is None:
+			process.PASS_FDS = (self.rfd, self.wfd)
+
+	def close(self):
+		"""Release the jobserver: the environment of the commands is
+		restored and the pipe created by Maat, if any, is closed."""
+		if self.exported:
+			if self.flags is None:
+				os.environ.pop("MAKEFLAGS", None)
+			else:
+				os.environ["MAKEFLAGS"] = self.flags
+		process.PASS_FDS = ()
+		for fd in self.fds:
+			os.close(fd)
+		if self.path is not None:
+			os.remove(self.path)
+
+
+def create(jobs, style = "pipe"):
+	"""Create and export a jobserver for the given number of jobs. style
+	is "pipe" (understood by any version of GNU make) or "fifo" (GNU
+	make 4.4 and later, ninja)."""
+	if style == "fifo":
+		path = os.path.abspath(common.work_path("jobserver-%d" % os.getpid()))
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		os.mkfifo(path, 0o600)
+		fd = os.open(path, os.O_RDWR)
+		server = JobServer(fd, fd, "fifo:" + path, jobs)
+		server.fds = [fd]
+		server.path = path
+	else:
+		rfd, wfd = os.pipe()
+		server = JobServer(rfd, wfd, "%d,%d" % (rfd, wfd), jobs)
+		server.fds = [rfd, wfd]
+	os.write(server.wfd, TOKEN * (jobs - 1))
+	server.export()
+	return server
+
+
+def connect():
+	"""Connect to the jobserver of the parent process given in MAKEFLAGS.
+	Return it, or None if there is none. Raise OSError if it cannot be
+	used (for example, make did not give its pipe to a command it does
+	not know to be a make)."""
+	flags = os.environ.get("MAKEFLAGS", "")
+	auths = AUTH_RE.findall(flags)
+	if not auths:
+		return None
+	auth = auths[-1]
+	jobs = None
+	for count in JOBS_RE.findall(flags):
+		if count:
+			jobs = int(count)
+	if auth.startswith("fifo:"):
+		fd = os.open(auth[5:], os.O_RDWR)
+		server = JobServer(fd, fd, auth, jobs)
+		server.fds = [fd]
+		return server
+	try:
+		rfd, wfd = [int(fd) for fd in auth.split(",")]
+	except ValueError:
+		raise OSError("bad jobserver: %s" % auth)
+	os.fstat(rfd)
+	os.fstat(wfd)
+	process.PASS_FDS = (rfd, wfd)
+	return JobServer(rfd, wfd, auth, jobs)
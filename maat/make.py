@@ -16,17 +16,36 @@
 
 """Make classes."""
 
-import os
+import heapq
+import queue
+import sys
+import threading
+import time
 
+import maat.common as common
+from maat import budget
 from maat import builtin
+from maat import io
+from maat.rule import get_db
+from maat import trace
 
 class Job:
+	"""A job represents the action of a rule that has to be performed.
+	It records the number of jobs it is waiting for and the jobs that
+	are waiting for it."""
+	__slots__ = ("rule", "count", "succs", "prio", "next", "reason")
 
 	def __init__(self, rule):
 		self.rule = rule
+		self.count = 0
+		self.succs = []
+		self.prio = 0.
+		self.next = None
+		self.reason = None
 
 	def make(self, mon):
-		self.rule.make(mon)
+		"""Perform the job and return True for success, False else."""
+		return self.rule.make(mon)
 
 
 class Maker:
@@ -34,9 +53,190 @@ class Maker:
 
 	def __init__(self, db):
 		self.db = db
+		self.count = 1
+		self.mon = None
+		self.jobs = []
+		self.done = {}
+		self.prof = None
+		self.history = None
+		self.buffered = False
+		self.jobserver = None
+		self.check_time = 0.
+
+	def check(self, rule):
+		"""Test if the rule needs update and return the reason or None,
+		recording the time spent if a profiler is installed."""
+		if self.prof is None:
+			return rule.why_update()
+		start = common.time()
+		res = rule.why_update()
+		self.check_time += common.time() - start
+		return res
+
+	def run(self, job):
+		"""Perform a job, recording its duration in the history and,
+		if a profiler is installed, its wall and CPU times. If the maker
+		is buffered, the output of the job is buffered and displayed at
+		once when the job ends. With a jobserver, a token is held while
+		the job runs. Return True for success, False else."""
+		if self.jobserver is not None:
+			token = self.jobserver.acquire()
+		start = common.time()
+		if self.prof is not None:
+			from maat import process
+			cpu = time.thread_time() + process.child_time()
+		if self.buffered:
+			output = io.Output()
+			io.set_output(output)
+		res = False
+		self.mon.start_job(job.rule)
+		try:
+			res = job.make(self.mon)
+		finally:
+			self.mon.end_job(job.rule, res)
+			if self.buffered:
+				io.set_output(None)
+				output.dump()
+			wall = common.time() - start
+			if self.jobserver is not None:
+				self.jobserver.release(token)
+			if self.prof is not None:
+				self.prof.add(job.rule.targets[0], trace.JOB, start, wall,
+					time.thread_time() + process.child_time() - cpu)
+		if res and self.history is not None:
+			self.history.record(job.rule, wall)
+		return res
+
+	def lookup(self, goal):
+		"""Get the rule to make the goal. If there is none, the goal
+		must be an existing file: it is recorded as up to date and None
+		is returned."""
+		try:
+			return self.db.rule_for(goal)
+		except KeyError:
+			if not common.STATS.exists(goal):
+				self.mon.print_fatal("no way to make %s" % goal)
+			self.done[goal] = None
+			return None
+
+	def collect(self, goal):
+		"""Collect the jobs needed to make the given goal. Return the job
+		making the goal or None if the goal is up to date.
+
+		The dependency graph is traversed in depth-first order with an
+		explicit stack so that deep graphs do not hit the recursion
+		limit. The jobs are added to the job list in topological order
+		and each rule is processed once, whatever its number of
+		targets. A dependency cycle is reported with the involved
+		goals."""
+		done = self.done
+		try:
+			return done[goal]
+		except KeyError:
+			pass
+		rule = self.lookup(goal)
+		if rule is None:
+			return None
+
+		# each frame is [rule, index of next source, predecessor jobs]
+		stack = [[rule, 0, {}]]
+		active = {rule}
+		while stack:
+			frame = stack[-1]
+			rule, i, preds = frame
+			sources = rule.sources
+			pushed = False
+			while i < len(sources):
+				source = sources[i]
+				try:
+					pred = done[source]
+				except KeyError:
+					srule = self.lookup(source)
+					if srule is None:
+						i += 1
+						continue
+					if srule in active:
+						chain = [f[0].targets[0] for f in stack]
+						chain = chain[chain.index(srule.targets[0]):]
+						self.mon.print_fatal("dependency cycle: %s -> %s"
+							% (" -> ".join(chain), source))
+					frame[1] = i
+					stack.append([srule, 0, {}])
+					active.add(srule)
+					pushed = True
+					break
+				if pred is not None:
+					preds[pred] = None
+				i += 1
+			if pushed:
+				continue
+
+			# all sources are processed: build the job if required
+			stack.pop()
+			active.remove(rule)
+			reason = None
+			if not preds:
+				reason = self.check(rule)
+			if preds or reason is not None:
+				job = Job(rule)
+				job.reason = reason
+				for pred in preds:
+					pred.succs.append(job)
+				job.count = len(preds)
+				self.jobs.append(job)
+			else:
+				job = None
+			for target in rule.targets:
+				done[target] = job
+		return done[goal]
+
+	def prepare(self, goals, mon):
+		"""Prepare the maker to make the given goals: the jobs list
+		is built in topological order. If there are jobs and actions
+		performed in worker processes, the pool of workers is started
+		before any thread is created."""
+		builtin.MON = mon
+		self.mon = mon
+		self.jobs = []
+		self.done = {}
+		self.check_time = 0.
+		start = common.time()
+		for goal in goals:
+			self.collect(goal)
+		if self.jobs and self.db.process:
+			from maat import pool
+			pool.start(self.count)
+		cache = get_db("cache")
+		if cache is not None:
+			cache.prefetch([job.rule for job in self.jobs if job.count == 0])
+		mon.start_build(len(self.jobs))
+		if self.prof is not None:
+			self.prof.add("dependency collection", trace.PHASE, start,
+				common.time() - start, args = {"up-to-date check": self.check_time})
 
 	def make(self, goals, mon):
-		pass
+		"""Make the given goals. Return True for success, False else."""
+		return True
+
+	def explain(self, goals, mon):
+		"""Display, without making them, the rules that have to be made
+		for the given goals with the first reason. Only the part of the
+		graph needed by the goals is visited. Return True."""
+		builtin.MON = mon
+		self.mon = mon
+		for goal in goals:
+			self.collect(goal)
+		for job in self.jobs:
+			reason = job.reason
+			if reason is None:
+				for source in job.rule.sources:
+					if self.done.get(source) is not None:
+						reason = "source %s is remade" % source
+						break
+			mon.print("%s: %s" % (job.rule.targets[0], reason))
+		if not self.jobs:
+			mon.print_info("all goals are up to date")
+		return True
 
 
 class SeqMaker(Maker):
@@ -45,36 +245,249 @@ class SeqMaker(Maker):
 	def __init__(self, db):
 		Maker.__init__(self, db)
 
-	def collect(self, goal):
-		if goal not in self.ready:
+	def make(self, goals, mon):
+		self.prepare(goals, mon)
+		for job in self.jobs:
+			if not self.run(job):
+				return False
+		return True
+
+
+class ParMaker(Maker):
+	"""Maker running independent jobs in parallel using a pool of
+	threads. A job is started as soon as all the jobs it depends on are
+	done and its resources fit in the budget (see module budget). After
+	the first failure, no more job is started and the maker waits for
+	the running ones to finish."""
+
+	def __init__(self, db, count):
+		Maker.__init__(self, db)
+		self.count = count
+		self.buffered = True
+		self.budget = budget.Budget(count)
+
+	def pop_ready(self, ready):
+		"""Remove from the ready jobs, and return, the job of highest
+		priority that fits in the budget, taking its resources. Return
+		None if there is none."""
+		if self.budget.full():
+			return None
+		skipped = []
+		job = None
+		while ready:
+			item = heapq.heappop(ready)
+			if self.budget.fits(item[2].rule):
+				job = item[2]
+				self.budget.take(job.rule)
+				break
+			skipped.append(item)
+		for item in skipped:
+			heapq.heappush(ready, item)
+		return job
+
+	def compute_priorities(self):
+		"""Compute the priority of the jobs as the length of the longest
+		path, in duration, from the job to the end of the build, using
+		the durations of the history. Return the job starting the
+		critical path."""
+		if self.history is None:
+			return None
+		default = self.history.average()
+		first = None
+		for job in reversed(self.jobs):
+			job.prio = 0.
+			job.next = None
+			for succ in job.succs:
+				if succ.prio > job.prio:
+					job.prio = succ.prio
+					job.next = succ
+			job.prio += self.history.get(job.rule, default)
+			if job.count == 0 and (first is None or job.prio > first.prio):
+				first = job
+		return first
+
+	def report_critical_path(self, mon):
+		"""Compute the priorities of the jobs and display the estimated
+		critical path."""
+		first = self.compute_priorities()
+		if first is not None and first.prio > 0:
+			count = 0
+			job = first
+			while job is not None:
+				count += 1
+				job = job.next
+			mon.print_info("estimated critical path: %s (%d jobs from %s)"
+				% (common.format_duration(first.prio).strip(), count,
+				first.rule.targets[0]))
+
+	def work(self, tasks, results):
+		"""Worker thread: perform the jobs from tasks and put the
+		outcome in results. Any exception, including SystemExit raised
+		by exit() or print_fatal() in an action, is passed to the
+		dispatcher that raises it again."""
+		while True:
+			job = tasks.get()
+			if job is None:
+				break
 			try:
-				rule = self.db.rule_for(goal)
-				if rule.needs_update():
-					for source in rule.sources:
-						self.collect(source)
-					self.jobs.append(Job(rule))
-					self.ready |= set(rule.targets)
-			except KeyError:
-				if not os.access(goal, os.R_OK):
-					self.mon.print_fatal("no way to make %s" % goal)
+				res = (job, self.run(job), None)
+			except BaseException:
+				res = (job, False, sys.exc_info())
+			results.put(res)
 
 	def make(self, goals, mon):
-		builtin.MON = mon
+		self.prepare(goals, mon)
+		if not self.jobs:
+			return True
 
-		# prepare state
-		self.mon = mon
-		self.jobs = []
-		self.ready = set()
+		# launch the workers
+		tasks = queue.Queue()
+		results = queue.Queue()
+		workers = []
+		for i in range(min(self.count, len(self.jobs))):
+			worker = threading.Thread(target=self.work, args=(tasks, results))
+			worker.daemon = True
+			worker.start()
+			workers.append(worker)
 
-		# collect the jobs
-		for goal in goals:
-			self.collect(goal)
-
-		# build the jobs
+		# dispatch the ready jobs, longest remaining path first
+		self.report_critical_path(mon)
+		self.budget.start()
+		poll = self.budget.get_poll()
+		ready = []
+		seq = 0
 		for job in self.jobs:
-			print("DEBUG:", job.rule.targets[0])
-			job.make(mon)
+			if job.count == 0:
+				heapq.heappush(ready, (-job.prio, seq, job))
+				seq += 1
+		running = 0
+		failed = False
+		exc = None
+		while True:
+			while ready and not failed and running < self.count:
+				job = self.pop_ready(ready)
+				if job is None:
+					break
+				tasks.put(job)
+				running += 1
+			if running == 0:
+				break
+			try:
+				job, res, info = results.get(timeout=poll)
+			except queue.Empty:
+				continue
+			running -= 1
+			self.budget.give(job.rule)
+			if not res:
+				failed = True
+				if exc is None:
+					exc = info
+			else:
+				for succ in job.succs:
+					succ.count -= 1
+					if succ.count == 0:
+						heapq.heappush(ready, (-succ.prio, seq, succ))
+						seq += 1
 
+		# stop the workers
+		for worker in workers:
+			tasks.put(None)
+		for worker in workers:
+			worker.join()
+		if exc is not None:
+			raise exc[1].with_traceback(exc[2])
+		return not failed
 
 
-	
+class AsyncMaker(ParMaker):
+	"""Maker running the jobs as tasks of an asyncio event loop, at most
+	count at once, in the same order as ParMaker. Asynchronous rule
+	bodies (using await, for example on ashell()) run in the event loop
+	thread and synchronous ones in the threads of the loop executor."""
+
+	async def arun(self, job):
+		"""Asynchronous version of run(). The CPU time is not recorded
+		as the jobs share the threads."""
+		import asyncio
+		if self.jobserver is not None:
+			token = await asyncio.to_thread(self.jobserver.acquire)
+		start = common.time()
+		output = io.Output()
+		io.set_output(output)
+		res = False
+		self.mon.start_job(job.rule)
+		try:
+			res = await job.rule.amake(self.mon)
+		finally:
+			self.mon.end_job(job.rule, res)
+			output.dump()
+			wall = common.time() - start
+			if self.jobserver is not None:
+				self.jobserver.release(token)
+			if self.prof is not None:
+				self.prof.add(job.rule.targets[0], trace.JOB, start, wall, 0.)
+		if res and self.history is not None:
+			self.history.record(job.rule, wall)
+		return res
+
+	async def aguard(self, job):
+		"""Run the job and return the pair (result, exception or None).
+		As asyncio stops the loop at once when a task raises SystemExit
+		(exit() or print_fatal() in an action), any exception is passed
+		to amake() that raises it again once the running jobs end."""
+		try:
+			return await self.arun(job), None
+		except BaseException as e:
+			return False, e
+
+	async def amake(self):
+		"""Run the prepared jobs."""
+		import asyncio
+		self.budget.start()
+		poll = self.budget.get_poll()
+		ready = []
+		seq = 0
+		for job in self.jobs:
+			if job.count == 0:
+				heapq.heappush(ready, (-job.prio, seq, job))
+				seq += 1
+		tasks = {}
+		failed = False
+		exc = None
+		while True:
+			while ready and not failed and len(tasks) < self.count:
+				job = self.pop_ready(ready)
+				if job is None:
+					break
+				tasks[asyncio.ensure_future(self.aguard(job))] = job
+			if not tasks:
+				break
+			done, _ = await asyncio.wait(tasks, timeout=poll,
+				return_when=asyncio.FIRST_COMPLETED)
+			for task in done:
+				job = tasks.pop(task)
+				self.budget.give(job.rule)
+				res, e = task.result()
+				if e is not None:
+					failed = True
+					if exc is None:
+						exc = e
+				elif not res:
+					failed = True
+				else:
+					for succ in job.succs:
+						succ.count -= 1
+						if succ.count == 0:
+							heapq.heappush(ready, (-succ.prio, seq, succ))
+							seq += 1
+		if exc is not None:
+			raise exc
+		return not failed
+
+	def make(self, goals, mon):
+		self.prepare(goals, mon)
+		if not self.jobs:
+			return True
+		import asyncio
+		self.report_critical_path(mon)
+		return asyncio.run(self.amake())
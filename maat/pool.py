@@ -0,0 +1,108 @@
+#	MAAT process pool for Python actions
+#	Copyright (C) 2022 H. Casse <hug.casse@gmail.com>
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Pool of worker processes performing the actions of the rules marked
+with the in_process() decorator, so that CPU-bound Python actions are
+not serialized by the GIL when the jobs run in parallel.
+
+The workers, as many as the jobs, are forked from the build process
+before its threads are created and once the rule functions are bound:
+the functions, that cannot be transferred, are found by the workers in
+their copy of the rule database from the first target of the rule.
+Only this target is sent to a worker that sends back the error
+message, if any, and the bytes written to the standard output and
+error by the action, its commands included. They are forwarded to the
+output of the job in the build process, as the output of a buffered
+job is displayed: the standard error, then the standard output. Hence
+the order of the writes to the two streams is not kept: the output of
+echo() comes after the command lines, even the ones printed after."""
+
+import os
+
+import maat.common as common
+from maat import io
+
+# rule database of the build (inherited by the workers)
+DB = None
+
+# pool of workers (None if not started)
+EXECUTOR = None
+
+
+def run(target):
+	"""Worker side: perform the action of the rule making the target.
+	Return the triple (error message or None, standard output, standard
+	error). The status caches, inherited from the build process, are
+	cleared as files may have been built since the fork."""
+	common.STATS.clear()
+	common.DIRS.clear()
+	rule = DB.rule_for(target)
+	output = io.Output()
+	io.set_output(output)
+	msg = None
+	try:
+		rule.get_fun()(rule)
+	except common.MaatError as e:
+		msg = str(e)
+	finally:
+		io.set_output(None)
+	return (msg,) + output.read()
+
+
+def start(jobs):
+	"""Start the pool with one worker per job. It must be called from
+	the main thread before the threads of the build are created: a
+	process forked once other threads exist may inherit locks they hold
+	and hang. The functions of the rules, that may be loaded from a
+	snapshot, are bound before so that the workers inherit them."""
+	global EXECUTOR
+	if EXECUTOR is not None:
+		return
+	for rule in DB.rules + DB.patterns:
+		try:
+			rule.get_fun()
+		except common.MaatError:
+			pass
+		break
+	import concurrent.futures
+	import multiprocessing
+	EXECUTOR = concurrent.futures.ProcessPoolExecutor(jobs,
+		mp_context=multiprocessing.get_context("fork"))
+
+	# the workers are forked at the first submission
+	EXECUTOR.submit(os.getpid).result()
+
+
+def call(rule, mon):
+	"""Perform the action of the rule in a worker and forward its output
+	to mon, the standard error first (see the module documentation).
+	Raise MaatError if the action fails."""
+	msg, out, err = EXECUTOR.submit(run, rule.targets[0]).result()
+	if err:
+		mon.write_err(err.decode(errors="replace"))
+	if out:
+		mon.write_out(out.decode(errors="replace"))
+	if msg is not None:
+		common.error(msg)
+
+
+def close():
+	"""Stop the workers, if any. They are started again for the next
+	build as the rule database may have changed."""
+	global EXECUTOR
+	if EXECUTOR is not None:
+		EXECUTOR.shutdown()
+		EXECUTOR = None
@@ -0,0 +1,114 @@
+#	MAAT process execution
+#	Copyright (C) 2022 H. Casse <hug.casse@gmail.com>
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Execution of external commands."""
+
+import os
+import re
+import shlex
+import subprocess
+import threading
+
+import maat.common as common
+from maat import io
+
+SHELL_RE = re.compile(r"[|&;<>()$`\\*?\[\]{}~#\n]")
+local = threading.local()
+
+# file descriptors given to the commands (jobserver pipe)
+PASS_FDS = ()
+
+SHELL_BUILTINS = {
+	".", ":", "alias", "cd", "eval", "exec", "exit", "export", "read",
+	"set", "source", "ulimit", "umask", "unset"
+}
+
+
+def split(cmd):
+	"""Split the command into arguments if it can be run without
+	a shell. Return None if a shell is required to run it."""
+	if SHELL_RE.search(cmd):
+		return None
+	try:
+		args = shlex.split(cmd)
+	except ValueError:
+		return None
+	if not args or "=" in args[0] or args[0] in SHELL_BUILTINS:
+		return None
+	return args
+
+
+def child_time():
+	"""Get the CPU time consumed by the commands run by the current
+	thread."""
+	return getattr(local, "cpu", 0.)
+
+
+def wait(proc):
+	"""Wait for the end of the process, account its CPU time to the
+	current thread and return its exit status."""
+	_, status, usage = os.wait4(proc.pid, 0)
+	proc.returncode = os.waitstatus_to_exitcode(status)
+	local.cpu = child_time() + usage.ru_utime + usage.ru_stime
+	return proc.returncode
+
+
+def get_streams():
+	"""Get the standard output and error to give to a command: the ones
+	of the output of the current job or None to inherit them."""
+	output = io.get_output()
+	if output is None:
+		return None, None
+	output.flush()
+	return output.get_out(), output.get_err()
+
+
+def run(cmd):
+	"""Run the given command and return its exit status. The command is
+	run without intermediate shell when possible. If the current job
+	has an output, the standard output and error of the command are
+	redirected to it, else they are inherited."""
+	out, err = get_streams()
+	args = split(cmd)
+	try:
+		if args is None:
+			proc = subprocess.Popen(cmd, shell=True, stdout=out, stderr=err,
+				pass_fds=PASS_FDS)
+		else:
+			proc = subprocess.Popen(args, stdout=out, stderr=err,
+				pass_fds=PASS_FDS)
+	except OSError as e:
+		common.error("cannot run %s: %s" % (cmd, e.strerror))
+	return wait(proc)
+
+
+async def run_async(cmd):
+	"""Run the command as run() but through the asyncio event loop so
+	that the thread is not blocked while the command runs. The CPU time
+	of the command is not accounted."""
+	import asyncio
+	out, err = get_streams()
+	args = split(cmd)
+	try:
+		if args is None:
+			proc = await asyncio.create_subprocess_shell(cmd, stdout=out,
+				stderr=err, pass_fds=PASS_FDS)
+		else:
+			proc = await asyncio.create_subprocess_exec(*args, stdout=out,
+				stderr=err, pass_fds=PASS_FDS)
+	except OSError as e:
+		common.error("cannot run %s: %s" % (cmd, e.strerror))
+	return await proc.wait()
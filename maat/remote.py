@@ -0,0 +1,283 @@
+#	MAAT remote build output cache
+#	Copyright (C) 2022 H. Casse <hug.casse@gmail.com>
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Remote build output cache shared by several machines, extending the
+local cache (module cache). The protocol is plain HTTP:
+* GET /ac/KEY -- get the entry of a rule key (404 if missing),
+* PUT /ac/KEY -- store the entry of a rule key,
+* GET /cas/HASH -- get an object by the hash of its content,
+* PUT /cas/HASH -- store an object.
+Keys and hashes are in hexadecimal. Transfers are performed by a pool
+of threads over persistent connections so that they overlap with the
+jobs.
+
+This module can also be run as a reference server storing the cache
+in a directory: python3 -m maat.remote [--host HOST] [--port PORT] DIR"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import http.client
+import http.server
+import io
+import os
+import queue
+import re
+import threading
+import urllib.parse
+
+BLOCK_SIZE = 1 << 16
+PATH_RE = re.compile(r"^/(ac|cas)/([0-9a-f]{32})$")
+
+
+class Pool:
+	"""Pool of persistent HTTP connections to a server."""
+
+	def __init__(self, url, timeout = 30):
+		url = urllib.parse.urlsplit(url)
+		if url.scheme == "https":
+			self.cls = http.client.HTTPSConnection
+		else:
+			self.cls = http.client.HTTPConnection
+		self.host = url.netloc
+		self.base = url.path.rstrip("/")
+		self.timeout = timeout
+		self.idle = queue.LifoQueue()
+
+	def request(self, method, path, body = None, size = None, out = None):
+		"""Perform a request and return the status. For a successful GET,
+		the body of the response is written to out. The request is
+		retried once on a new connection if the connection fails."""
+		for i in range(2):
+			try:
+				if i != 0:
+					raise queue.Empty()
+				conn = self.idle.get_nowait()
+			except queue.Empty:
+				conn = self.cls(self.host, timeout=self.timeout)
+			try:
+				headers = {}
+				if size is not None:
+					headers["Content-Length"] = str(size)
+				if body is not None and hasattr(body, "seek"):
+					body.seek(0)
+				conn.request(method, self.base + path, body, headers)
+				resp = conn.getresponse()
+				if out is not None and resp.status == 200:
+					buf = resp.read(BLOCK_SIZE)
+					while buf:
+						out.write(buf)
+						buf = resp.read(BLOCK_SIZE)
+				else:
+					resp.read()
+				self.idle.put(conn)
+				return resp.status
+			except (OSError, http.client.HTTPException):
+				conn.close()
+				if i == 1:
+					raise
+
+
+class RemoteCache:
+	"""Remote part of a local cache."""
+
+	def __init__(self, url, local, count = 8):
+		self.pool = Pool(url)
+		self.local = local
+		self.executor = concurrent.futures.ThreadPoolExecutor(count)
+		self.fetches = {}
+		self.pushes = []
+		self.errors = 0
+		self.lock = threading.Lock()
+
+	def fetch_entry(self, key):
+		"""Download the entry of the key. Return it or None if it is not
+		in the remote cache."""
+		buf = io.BytesIO()
+		if self.pool.request("GET", "/ac/" + key.hex(), out=buf) != 200:
+			return None
+		buf.seek(0)
+		return self.local.read_entry(buf)
+
+	def fetch(self, key):
+		"""Download the entry of the base key, following the manifest if
+		any, and its objects in the local cache. The entries are only
+		written once the objects are there so that a concurrent lookup
+		never finds an incomplete entry. Return True if the entry is now
+		in the local cache."""
+		if self.local.lookup(key) is not None:
+			return True
+		try:
+			entries = []
+			targets, discovered = self.fetch_entry(key) or (None, None)
+			if targets is None:
+				if discovered is None:
+					return False
+				entries.append((key, None, discovered))
+				key = self.local.extend_key(key, discovered)
+				if key is None:
+					return False
+				targets, discovered = self.fetch_entry(key) or (None, None)
+				if targets is None:
+					return False
+			entries.append((key, targets, discovered))
+			for _, digest, _ in targets:
+				obj = self.local.get_object(digest)
+				if not os.path.exists(obj):
+					os.makedirs(os.path.dirname(obj), exist_ok=True)
+					tmp = "%s.%d.tmp" % (obj, threading.get_ident())
+					with open(tmp, "wb") as file:
+						status = self.pool.request("GET", "/cas/" + digest.hex(), out=file)
+					if status != 200:
+						os.remove(tmp)
+						return False
+					self.local.add_object(tmp, obj)
+			for key, targets, discovered in reversed(entries):
+				self.local.write_entry(key, targets, discovered)
+			return True
+		except (OSError, http.client.HTTPException, ValueError, TypeError, EOFError):
+			with self.lock:
+				self.errors += 1
+			return False
+
+	def prefetch(self, rule):
+		"""Start fetching the entry of a rule whose sources are up to
+		date."""
+		name = rule.targets[0]
+		if name not in self.fetches:
+			self.fetches[name] = self.executor.submit(
+				lambda: self.fetch_rule(rule))
+
+	def fetch_rule(self, rule):
+		"""Fetch the entry of the rule. Return True if it is now in the
+		local cache."""
+		key = self.local.key(rule)
+		return key is not None and self.fetch(key)
+
+	def wait(self, rule):
+		"""Wait for the end of the fetch of the rule, starting it if
+		needed (in the current thread). Return True if the entry of
+		the rule is in the local cache."""
+		future = self.fetches.pop(rule.targets[0], None)
+		if future is None or not future.result():
+			return self.fetch_rule(rule)
+		return True
+
+	def push(self, keys, targets):
+		"""Upload, in background, the entries of the given keys and the
+		objects of the targets."""
+		self.pushes.append(self.executor.submit(lambda: self.upload(keys, targets)))
+
+	def upload(self, keys, targets):
+		"""Upload the entries and the objects. The entries are uploaded
+		last so that the remote cache never refers to missing objects."""
+		try:
+			for _, digest, _ in targets:
+				obj = self.local.get_object(digest)
+				with open(obj, "rb") as file:
+					self.pool.request("PUT", "/cas/" + digest.hex(), file,
+						os.fstat(file.fileno()).st_size)
+			for key in reversed(keys):
+				with open(self.local.get_entry(key), "rb") as file:
+					self.pool.request("PUT", "/ac/" + key.hex(), file.read())
+		except (OSError, http.client.HTTPException):
+			with self.lock:
+				self.errors += 1
+
+	def close(self):
+		"""Wait for the end of the uploads and stop the transfers."""
+		for future in self.fetches.values():
+			future.cancel()
+		concurrent.futures.wait(self.pushes)
+		self.executor.shutdown()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+	"""Request handler of the reference server."""
+	protocol_version = "HTTP/1.1"
+
+	def get_path(self):
+		m = PATH_RE.match(self.path)
+		if m is None:
+			self.send_error(400)
+			return None
+		return os.path.join(self.server.dir, m.group(1), m.group(2))
+
+	def do_GET(self):
+		path = self.get_path()
+		if path is None:
+			return
+		try:
+			file = open(path, "rb")
+		except OSError:
+			self.send_error(404)
+			return
+		with file:
+			self.send_response(200)
+			self.send_header("Content-Length", str(os.fstat(file.fileno()).st_size))
+			self.end_headers()
+			buf = file.read(BLOCK_SIZE)
+			while buf:
+				self.wfile.write(buf)
+				buf = file.read(BLOCK_SIZE)
+
+	def do_PUT(self):
+		path = self.get_path()
+		if path is None:
+			return
+		size = int(self.headers.get("Content-Length", 0))
+		tmp = "%s.%d.tmp" % (path, id(self))
+		h = hashlib.blake2b(digest_size=16)
+		with open(tmp, "wb") as file:
+			while size > 0:
+				buf = self.rfile.read(min(size, BLOCK_SIZE))
+				if not buf:
+					break
+				h.update(buf)
+				file.write(buf)
+				size -= len(buf)
+		if size > 0 or ("/cas/" in self.path and h.hexdigest() != os.path.basename(path)):
+			os.remove(tmp)
+			self.send_error(400)
+			return
+		os.replace(tmp, path)
+		self.send_response(201)
+		self.send_header("Content-Length", "0")
+		self.end_headers()
+
+	def log_message(self, format, *args):
+		pass
+
+
+def serve(dir, host = "localhost", port = 8080):
+	"""Run the reference server storing the cache in dir."""
+	for sub in ("ac", "cas"):
+		os.makedirs(os.path.join(dir, sub), exist_ok=True)
+	server = http.server.ThreadingHTTPServer((host, port), Handler)
+	server.dir = dir
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = "Maat remote cache server")
+	parser.add_argument('dir', help="Directory storing the cache.")
+	parser.add_argument('--host', default="localhost", help="Host to listen to.")
+	parser.add_argument('--port', type=int, default=8080, help="Port to listen to.")
+	args = parser.parse_args()
+	serve(args.dir, args.host, args.port)
@@ -18,65 +18,200 @@
 """"Classes managing the rules."""
 
 import os.path
+import sys
+
 import maat.common as common
 
+def get_db(name):
+	"""Get the database of the module maat.name (sign, deps or cache).
+	The modules are only imported when their database is used: None is
+	returned if the module is not loaded."""
+	module = sys.modules.get("maat." + name)
+	return None if module is None else module.DB
+
+
+def intern_paths(paths):
+	"""Build the tuple of the interned paths so that a path shared by
+	several rules (and the map of the database) is stored only once."""
+	return tuple([sys.intern(str(p)) for p in paths])
+
+
 class Rule:
-	"""Represents a rule to make a file."""
+	"""Represents a rule to make a file. As build graphs may contain
+	hundreds of thousands of rules, the rules are slotted and their
+	targets and sources are tuples of interned paths. res gives the
+	resources used by the action (see module budget), None for the
+	default."""
+	__slots__ = ("targets", "sources", "file", "line", "stem", "depfile", "res")
 
 	def __init__(self, targets, sources):
-		self.targets = targets
-		self.sources = sources
+		self.targets = intern_paths(targets)
+		self.sources = intern_paths(sources)
 		self.file = None
 		self.line = None
+		self.stem = None
+		self.depfile = None
+		self.res = None
+
+	def signature(self):
+		"""Get the signature of the action of the rule."""
+		return b""
+
+	def get_inputs(self):
+		"""Get the sources of the rule extended with the dependencies
+		discovered the last time it was made."""
+		deps = get_db("deps")
+		if deps is None:
+			return self.sources
+		extra = deps.get(self)
+		if extra:
+			return self.sources + tuple(extra)
+		else:
+			return self.sources
+
+	def record(self, start):
+		"""Called when the rule has been successfully made, the action
+		having started at date start, or None if the targets have been
+		restored from the cache."""
+		deps = get_db("deps")
+		if deps is not None and start is not None:
+			deps.update(self, start)
+		signs = get_db("sign")
+		if signs is not None:
+			signs.record(self)
+
+	async def amake(self, mon):
+		"""Make the rule from an asynchronous maker. By default, call
+		make() (defined by the sub-classes)."""
+		return self.make(mon)
 
 	def needs_update(self):
+		"""Test if the rule needs to be made."""
+		return self.why_update() is not None
+
+	def why_update(self):
+		"""Get the first reason, as a string, why the rule needs to be
+		made, or None if it is up to date."""
+
+		# signature mode
+		signs = get_db("sign")
+		if signs is not None:
+			return signs.check(self)
 
 		# get youngest target
 		d = 0.
 		for target in self.targets:
 			try:
-				fd = os.path.getmtime(target)
+				fd = common.STATS.get_mod_time(target)
 				if fd > d:
 					d = fd
 			except OSError:
-				#print("DEBUG: update as %s does not exist" % target)
-				return True
-		#print("DEBUG: target date = %f" % d)
+				return "missing target %s" % target
 
 		# check for date in sources
-		for sources in self.sources:
+		for source in self.get_inputs():
 			try:
-				fd = os.path.getmtime(source)
+				fd = common.STATS.get_mod_time(source)
 				if fd > d:
-					#print("DEBUG: update for %s: %f", source, fd)
-					return True
+					return "newer source %s" % source
 			except OSError:
-				#print("DEBUG: update as %s does not exist" % source)
-				return True
+				return "missing source %s" % source
 
 		# no update needed
-		return False
-		
+		return None
+
+
+# maximal number of chained pattern rules to make a source
+MAX_CHAIN = 4
+
 
 class DataBase:
 	"""Represents the database of rules, i.e. list of existing rules
-	and map between files and the rule."""
+	and map between files and the rule.
+
+	Pattern rules are indexed by the suffix of their target patterns
+	(the part after "%"). To find the patterns matching a goal, only
+	one lookup per distinct suffix length is performed, the longest
+	suffixes being tried first. The rules instantiated from patterns
+	are added to the database only when a goal requires them.
+
+	process is True if the action of a rule is performed in a worker
+	process (see module pool)."""
 
 	def __init__(self):
 		self.rules = []
 		self.map = {}
+		self.patterns = []
+		self.suffixes = {}
+		self.lengths = []
+		self.process = False
 
 	def add(self, rule):
 		self.rules.append(rule)
 		for target in rule.targets:
 			self.map[target] = rule
 
+	def add_pattern(self, rule):
+		"""Add a pattern rule."""
+		self.patterns.append(rule)
+		for target in rule.targets:
+			prefix, suffix = target.split("%", 1)
+			self.suffixes.setdefault(suffix, []).append((prefix, rule))
+			if len(suffix) not in self.lengths:
+				self.lengths.append(len(suffix))
+				self.lengths.sort(reverse=True)
+
+	def match(self, goal):
+		"""Generate the pairs (pattern rule, stem) matching the goal."""
+		for length in self.lengths:
+			if length >= len(goal):
+				continue
+			for prefix, rule in self.suffixes.get(goal[len(goal) - length:], ()):
+				if len(prefix) + length < len(goal) and goal.startswith(prefix):
+					yield rule, goal[len(prefix):len(goal) - length]
+
+	def can_make(self, path, depth):
+		"""Test if the path exists, has an explicit rule or can be made
+		by a chain of at most depth pattern rules. As in make, the
+		match-anything patterns (target "%") are not chained, else any
+		missing file could be made from an endless chain of sources."""
+		if path in self.map or common.STATS.exists(path):
+			return True
+		if depth == 0:
+			return False
+		for prule, stem in self.match(path):
+			if "%" in prule.targets:
+				continue
+			for source in prule.sources:
+				if not self.can_make(source.replace("%", stem), depth - 1):
+					break
+			else:
+				return True
+		return False
+
 	def rule_for(self, goal):
-		return self.map[goal]
+		"""Get the rule to make the goal. If there is no explicit rule,
+		use the first matching pattern rule whose sources exist or can
+		be made (see can_make()). Raise KeyError if there is no rule."""
+		try:
+			return self.map[goal]
+		except KeyError:
+			if not self.patterns:
+				raise
+		for prule, stem in self.match(goal):
+			rule = prule.instantiate(stem)
+			for source in rule.sources:
+				if not self.can_make(source, MAX_CHAIN):
+					break
+			else:
+				self.add(rule)
+				return rule
+		raise KeyError(goal)
 
 
 class FunRule(Rule):
 	"""Represents a rule which action is implemented by a function."""
+	__slots__ = ("fun",)
 
 	def __init__(self, targets, sources, fun):
 		Rule.__init__(self, targets, sources)
@@ -86,9 +221,128 @@ class FunRule(Rule):
 		return " ".join(self.targets) + ":" + " ".join(self.sources) \
 			+ "\n\t" + "code %s:%d\n" % (self.file, self.line)
 
+	def signature(self):
+		from maat import sign
+		return sign.hash_fun(self.fun)
+
+	def get_fun(self):
+		"""Get the function implementing the action."""
+		return self.fun
+
+	def restore(self):
+		"""Restore the targets from the output cache, if any. Return True
+		if they have been restored."""
+		cache = get_db("cache")
+		if cache is not None:
+			if cache.restore(self):
+				self.record(None)
+				return True
+			cache.unshare(self)
+		return False
+
+	def finish(self, start):
+		"""Called after the action, started at date start, is performed,
+		successfully or not."""
+		for target in self.targets:
+			common.STATS.invalidate(target)
+			common.DIRS.invalidate(os.path.dirname(target))
+
+	def store(self, start):
+		"""Record the rule successfully made from date start and store its
+		targets in the output cache. Return True."""
+		self.record(start)
+		cache = get_db("cache")
+		if cache is not None:
+			cache.store(self)
+		return True
+
+	def call(self, fun, mon):
+		"""Call the function of the action, in a worker process if it is
+		marked by in_process(). Return its result."""
+		if getattr(fun, "maat_process", False):
+			from maat import pool
+			return pool.call(self, mon)
+		return fun(self)
+
 	def make(self, mon):
+		if self.restore():
+			return True
+		start = common.time()
+		try:
+			fun = self.get_fun()
+			res = self.call(fun, mon)
+
+			# asynchronous body outside of an asynchronous maker
+			if res is not None and hasattr(res, "__await__"):
+				import asyncio
+				asyncio.run(res)
+		except common.MaatError as e:
+			mon.print_error(e)
+			return False
+		finally:
+			self.finish(start)
+		return self.store(start)
+
+	async def amake(self, mon):
+		"""Asynchronous version of make(): an asynchronous body is awaited
+		and a synchronous one is run in a thread of the event loop
+		executor, as the cache operations are."""
+		import asyncio
+		cache = get_db("cache")
+		if cache is not None and await asyncio.to_thread(self.restore):
+			return True
+		start = common.time()
 		try:
-			self.fun(self)
+			fun = self.get_fun()
+			if asyncio.iscoroutinefunction(fun):
+				await fun(self)
+			else:
+				await asyncio.to_thread(self.call, fun, mon)
 		except common.MaatError as e:
 			mon.print_error(e)
 			return False
+		finally:
+			self.finish(start)
+		if cache is not None:
+			return await asyncio.to_thread(self.store, start)
+		return self.store(start)
+
+
+class PatternRule:
+	"""Represents a rule whose targets and sources contain the pattern
+	"%", instantiated as a FunRule for each goal matching one of its
+	target patterns, "%" being replaced by the matched stem."""
+	__slots__ = ("targets", "sources", "fun", "file", "line", "res")
+
+	def __init__(self, targets, sources, fun):
+		self.targets = tuple(targets)
+		self.sources = tuple(sources)
+		self.fun = fun
+		self.file = None
+		self.line = None
+		self.res = None
+
+	def __repr__(self):
+		return " ".join(self.targets) + ":" + " ".join(self.sources) \
+			+ "\n\t" + "code %s:%d\n" % (self.file, self.line)
+
+	def signature(self):
+		"""Get the signature of the action of the rule."""
+		from maat import sign
+		return sign.hash_fun(self.fun)
+
+	def get_fun(self):
+		"""Get the function implementing the action."""
+		return self.fun
+
+	def instantiate(self, stem):
+		"""Build the rule for the given stem."""
+		rule = FunRule(
+			[t.replace("%", stem) for t in self.targets],
+			[s.replace("%", stem) for s in self.sources],
+			self.fun)
+		rule.file = self.file
+		rule.line = self.line
+		rule.stem = stem
+		rule.res = self.res
+		return rule
@@ -0,0 +1,164 @@
+#	MAAT signature database
+#	Copyright (C) 2022 H. Casse <hug.casse@gmail.com>
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Signature database: in signature mode, a rule is up to date if its
+command and the contents of its sources are the same as the last time
+the rule was made. The contents are compared using hashes stored in
+the work directory. A file is only re-hashed if its stat() information
+changed since it was hashed."""
+
+import hashlib
+import types
+
+import maat.common as common
+
+BLOCK_SIZE = 1 << 16
+RACY_DELAY = 2 * 1000000000
+
+# signature database (None for date-based update)
+DB = None
+
+
+def hash_file(path):
+	"""Compute the hash of the content of the given file."""
+	h = hashlib.blake2b(digest_size=16)
+	with open(path, "rb") as file:
+		buf = file.read(BLOCK_SIZE)
+		while buf:
+			h.update(buf)
+			buf = file.read(BLOCK_SIZE)
+	return h.digest()
+
+
+def represent(value):
+	"""Get a stable textual representation of a value used by an action.
+	The functions, classes and modules are represented by nothing, as
+	their code is not hashed, and other objects by their str() if they
+	define it: the default representation contains their address that
+	changes at each run."""
+	if value is None or value is Ellipsis \
+	or isinstance(value, (str, bytes, int, float, complex)):
+		return repr(value)
+	elif isinstance(value, (list, tuple)):
+		return "[%s]" % ", ".join(represent(v) for v in value)
+	elif isinstance(value, (set, frozenset)):
+		return "{%s}" % ", ".join(sorted(represent(v) for v in value))
+	elif isinstance(value, dict):
+		return "{%s}" % ", ".join("%s: %s" % (represent(k), represent(v))
+			for k, v in value.items())
+	elif callable(value) or isinstance(value, types.ModuleType):
+		return ""
+	elif type(value).__str__ is not object.__str__:
+		return str(value)
+	else:
+		return ""
+
+
+def hash_fun(fun):
+	"""Compute the signature of the action of a rule function, that is,
+	its code, its constants (containing the command strings), the values
+	it captured and the values of the global variables it reads (as the
+	expanded variables of the commands). The values are represented by
+	represent() as the order of the sets, frozenset constants included,
+	changes with the hash seed of each run."""
+	h = hashlib.blake2b(digest_size=16)
+	names = set()
+	def add(code):
+		h.update(code.co_code)
+		h.update(" ".join(code.co_names).encode())
+		names.update(code.co_names)
+		for c in code.co_consts:
+			if isinstance(c, types.CodeType):
+				add(c)
+			else:
+				h.update(represent(c).encode())
+	add(fun.__code__)
+	h.update(represent(fun.__defaults__).encode())
+	if fun.__closure__:
+		for cell in fun.__closure__:
+			h.update(represent(cell.cell_contents).encode())
+	glob = fun.__globals__
+	for name in sorted(names):
+		if name in glob:
+			h.update(("\0%s=%s" % (name, represent(glob[name]))).encode())
+	return h.digest()
+
+
+class SignDB(common.Store):
+	"""Database of signatures. For each file, it records the stat()
+	information and the hash of the content. For each rule, identified
+	by its first target, it records the signature of the command and
+	the hashes of the sources the last time it was made."""
+
+	def __init__(self):
+		common.Store.__init__(self, "signs")
+
+	def default(self):
+		return {"files": {}, "rules": {}}
+
+	def digest(self, path):
+		"""Get the hash of the given file. Return None if the file
+		does not exist."""
+		st = common.STATS.stat(path)
+		if st is None:
+			return None
+		key = (st.st_size, st.st_mtime_ns, st.st_ino)
+		files = self.data["files"]
+		info = files.get(path)
+		if info is not None and info[0] == key:
+			return info[1]
+		digest = hash_file(path)
+
+		# a file modified too recently may change again without
+		# modifying its stat() information: re-hash it next time
+		if common.time() * 1000000000 - st.st_mtime_ns < RACY_DELAY:
+			key = None
+		with self.lock:
+			files[path] = (key, digest)
+			self.modified = True
+		return digest
+
+	def check(self, rule):
+		"""Check if the rule needs to be updated. Return the reason
+		as a string if it needs update, None else."""
+		for target in rule.targets:
+			if not common.STATS.exists(target):
+				return "missing target %s" % target
+		record = self.data["rules"].get(rule.targets[0])
+		if record is None:
+			return "no signature"
+		if record[0] != rule.signature():
+			return "changed command"
+		sources = record[1]
+		inputs = rule.get_inputs()
+		if len(sources) != len(inputs):
+			return "changed sources"
+		for source in inputs:
+			digest = self.digest(source)
+			if digest is None:
+				return "missing source %s" % source
+			if sources.get(source) != digest:
+				return "changed source %s" % source
+		return None
+
+	def record(self, rule):
+		"""Record the signatures of a rule that has just been made."""
+		sources = {}
+		for source in rule.get_inputs():
+			sources[source] = self.digest(source)
+		with self.lock:
+			self.data["rules"][rule.targets[0]] = (rule.signature(), sources)
+			self.modified = True
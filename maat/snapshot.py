@@ -0,0 +1,203 @@
+#	MAAT rule graph snapshot
+#	Copyright (C) 2022 H. Casse <hug.casse@gmail.com>
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Snapshot of the rule graph built by the scripts. Once the scripts
+have been run, the rules they define (targets, sources, file, line and
+signature of the action) are saved in the work directory with the
+hashes of the scripts. While the scripts are unchanged, the next runs
+rebuild the database from the snapshot, memory-mapped, instead of
+running the scripts. The directories scanned by the scripts (see
+common.DirCache) are recorded too: the snapshot is also invalidated
+when a file is added to or removed from one of them.
+
+The actions of the rules are functions created by running the scripts:
+they are only bound, by running the scripts once, when a rule has to
+be made. Rules are identified by their rank in the definition order:
+if the run does not define the same rules as the snapshot (a script
+not recorded, as a sub-directory given by the environment, defines
+other ones), the binding fails and the snapshot is removed."""
+
+import hashlib
+import importlib.util
+import marshal
+import mmap
+import os
+import threading
+
+import maat.common as common
+from maat import VERSION
+from maat import rule
+
+FORMAT = 3
+HEADER = importlib.util.MAGIC_NUMBER + ("maat-graph-%s-%d\n" % (VERSION, FORMAT)).encode()
+
+
+def hash_script(path):
+	"""Compute the hash of the content of a script. Return None if it
+	cannot be read."""
+	try:
+		with open(path, "rb") as file:
+			return hashlib.blake2b(file.read(), digest_size=16).digest()
+	except OSError:
+		return None
+
+
+class SnapRule(rule.FunRule):
+	"""Rule loaded from a snapshot: its function is bound when the rule
+	is made and its signature is the one recorded in the snapshot. As
+	the targets and the sources come from the snapshot, they are
+	already tuples of interned paths."""
+	__slots__ = ("snap", "index", "sign")
+
+	def __init__(self, targets, sources, snap, index, sign):
+		self.targets = targets
+		self.sources = sources
+		self.fun = None
+		self.file = None
+		self.line = None
+		self.stem = None
+		self.depfile = None
+		self.res = None
+		self.snap = snap
+		self.index = index
+		self.sign = sign
+
+	def signature(self):
+		return self.sign
+
+	def get_fun(self):
+		if self.fun is None:
+			self.fun = self.snap.get_fun(self.index)
+		return self.fun
+
+
+class SnapPatternRule(rule.PatternRule):
+	"""Pattern rule loaded from a snapshot."""
+	__slots__ = ("snap", "index", "sign")
+
+	def __init__(self, targets, sources, snap, index, sign):
+		rule.PatternRule.__init__(self, targets, sources, None)
+		self.snap = snap
+		self.index = index
+		self.sign = sign
+
+	def signature(self):
+		return self.sign
+
+	def get_fun(self):
+		return self.snap.get_fun(self.index)
+
+	def instantiate(self, stem):
+		r = SnapRule(
+			rule.intern_paths([t.replace("%", stem) for t in self.targets]),
+			rule.intern_paths([s.replace("%", stem) for s in self.sources]),
+			self.snap, self.index, self.sign)
+		r.file = self.file
+		r.line = self.line
+		r.stem = stem
+		r.res = self.res
+		return r
+
+
+class Snapshot:
+	"""Snapshot of the rule graph of the script path. bind is called,
+	at most once, to run the scripts and must return the pair (list of
+	the functions, list of the pairs (targets, sources)) of the rules in
+	definition order."""
+
+	def __init__(self, path, bind):
+		name = hashlib.blake2b(os.path.abspath(path).encode(),
+			digest_size=8).hexdigest()
+		self.path = common.work_path("graph-%s" % name)
+		self.bind = bind
+		self.funs = None
+		self.rules = []
+		self.error = None
+		self.lock = threading.Lock()
+
+	def get_fun(self, index):
+		"""Get the function of the rule of the given rank. Raise
+		MaatError if the rules defined by the scripts are not the ones
+		of the snapshot."""
+		with self.lock:
+			if self.funs is None and self.error is None:
+				funs, rules = self.bind()
+				if rules == [(r.targets, r.sources) for r in self.rules]:
+					self.funs = funs
+				else:
+					self.error = "the scripts do not define the rules of " \
+						"the saved rule graph: run Maat again"
+					try:
+						os.remove(self.path)
+					except OSError:
+						pass
+			if self.error is not None:
+				common.error(self.error)
+		return self.funs[index]
+
+	def load(self):
+		"""Load the snapshot. Return the triple (database, first goal,
+		scanned directories) or None if there is no snapshot, a script
+		changed or a scanned directory changed."""
+		try:
+			with open(self.path, "rb") as file:
+				with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as map:
+					if map[:len(HEADER)] != HEADER:
+						return None
+					with memoryview(map) as view:
+						scripts, dirs, rules, first_goal, process = marshal.loads(view[len(HEADER):])
+		except (OSError, EOFError, ValueError, TypeError):
+			return None
+		for path, h in scripts:
+			if hash_script(path) != h:
+				return None
+		if common.DIRS.changed(dirs):
+			return None
+		db = rule.DataBase()
+		db.process = process
+		for index, (pattern, targets, sources, file, line, sign, res) in enumerate(rules):
+			if pattern:
+				r = SnapPatternRule(targets, sources, self, index, sign)
+				db.add_pattern(r)
+			else:
+				r = SnapRule(targets, sources, self, index, sign)
+				db.add(r)
+			r.file = file
+			r.line = line
+			r.res = res
+			self.rules.append(r)
+		return db, first_goal, dirs
+
+	def save(self, scripts, dirs, rules, first_goal):
+		"""Save the snapshot of the rules, in definition order, built
+		by the given scripts that scanned the given directories (map of
+		the directories to their modification date)."""
+		data = (
+			[(path, hash_script(path)) for path in scripts],
+			dirs,
+			[(isinstance(r, rule.PatternRule), r.targets, r.sources,
+				r.file, r.line, r.signature(), r.res) for r in rules],
+			first_goal,
+			any(getattr(r.fun, "maat_process", False) for r in rules)
+		)
+		try:
+			os.makedirs(os.path.dirname(self.path), exist_ok=True)
+			with open(self.path + ".tmp", "wb") as file:
+				file.write(HEADER)
+				marshal.dump(data, file)
+			os.replace(self.path + ".tmp", self.path)
+		except OSError:
+			pass
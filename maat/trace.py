@@ -0,0 +1,130 @@
+#	MAAT build profiling
+#	Copyright (C) 2022 H. Casse <hug.casse@gmail.com>
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Profiling of the build: records the duration of the build phases
+and of the jobs. The records can be exported as Chrome trace events
+(viewable in chrome://tracing or Perfetto) or summarized as the list of
+slowest rules."""
+
+import os
+import threading
+
+import maat.common as common
+
+PHASE = "phase"
+JOB = "job"
+
+
+class Event:
+	"""An event of the profile, that is, a named duration. start is
+	relative to the beginning of the profile and cpu is the CPU time,
+	including the one of the sub-processes, or None."""
+
+	def __init__(self, name, cat, start, wall, cpu, thread, args):
+		self.name = name
+		self.cat = cat
+		self.start = start
+		self.wall = wall
+		self.cpu = cpu
+		self.thread = thread
+		self.args = args
+
+
+class Profiler:
+	"""Records the events of a build."""
+
+	def __init__(self):
+		self.origin = common.time()
+		self.events = []
+		self.threads = {}
+		self.lock = threading.Lock()
+
+	def add(self, name, cat, start, wall, cpu = None, args = None):
+		"""Record an event starting at time start (as returned by
+		common.time()) and lasting wall seconds."""
+		with self.lock:
+			ident = threading.get_ident()
+			try:
+				thread = self.threads[ident]
+			except KeyError:
+				thread = len(self.threads) + 1
+				self.threads[ident] = thread
+			self.events.append(Event(name, cat, start - self.origin,
+				wall, cpu, thread, args))
+
+	def get(self, cat):
+		"""Get the events of the given category."""
+		return [e for e in self.events if e.cat == cat]
+
+	def write_trace(self, path):
+		"""Write the events as Chrome trace event JSON file."""
+		events = []
+		for e in self.events:
+			args = dict(e.args) if e.args else {}
+			if e.cpu is not None:
+				args["cpu"] = e.cpu
+			events.append({
+				"name": e.name,
+				"cat": e.cat,
+				"ph": "X",
+				"ts": int(e.start * 1000000),
+				"dur": int(e.wall * 1000000),
+				"pid": os.getpid(),
+				"tid": e.thread,
+				"args": args
+			})
+		import json
+		with open(path, "w") as file:
+			json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+	def summarize(self, mon, count = 10):
+		"""Display the duration of the phases and the slowest jobs."""
+		for e in self.get(PHASE):
+			mon.print("%s %s" % (common.format_duration(e.wall), e.name))
+			if e.args:
+				for name, d in e.args.items():
+					mon.print("%s   %s" % (common.format_duration(d), name))
+		jobs = sorted(self.get(JOB), key=lambda e: e.wall, reverse=True)
+		if jobs:
+			mon.print("slowest rules (wall, CPU):")
+			for e in jobs[:count]:
+				mon.print("%s %s %s" % (common.format_duration(e.wall),
+					common.format_duration(e.cpu), e.name))
+
+
+class History(common.Store):
+	"""Durations of the rules measured the last time they were made,
+	identified by their first target."""
+
+	def __init__(self):
+		common.Store.__init__(self, "times")
+
+	def record(self, rule, duration):
+		"""Record the duration of a rule that has just been made."""
+		with self.lock:
+			self.data[rule.targets[0]] = duration
+			self.modified = True
+
+	def get(self, rule, default = None):
+		"""Get the last duration of the rule or default."""
+		return self.data.get(rule.targets[0], default)
+
+	def average(self):
+		"""Get the average duration of the recorded rules (0 if there
+		is no record)."""
+		if not self.data:
+			return 0.
+		return sum(self.data.values()) / len(self.data)
@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+#
+#	MAAT benchmark of dependency collection
+#	Copyright (C) 2022 H. Casse <hug.casse@gmail.com>
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark of the dependency collection of the makers on synthetic
+graphs. Usage: collect.py [SIZE...] (default sizes: 10000 100000)."""
+
+import os.path
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+import maat.common as common
+import maat.io
+import maat.make
+import maat.rule
+
+
+class BenchRule(maat.rule.Rule):
+	"""Rule always needing update, to measure only graph traversal."""
+
+	def why_update(self):
+		return "bench"
+
+
+def make_graph(size, fanin = 4, seed = 0):
+	"""Build a database of size rules: rule i depends on the rule i-1
+	(making a chain as deep as the graph) and on fanin random previous
+	rules. Goal of the graph is the last rule."""
+	rand = random.Random(seed)
+	db = maat.rule.DataBase()
+	for i in range(size):
+		sources = []
+		if i > 0:
+			sources.append("n%d" % (i - 1))
+			for j in range(fanin):
+				sources.append("n%d" % rand.randrange(i))
+		db.add(BenchRule(["n%d" % i], sources))
+	return db, "n%d" % (size - 1)
+
+
+def bench(size):
+	db, goal = make_graph(size)
+	maker = maat.make.Maker(db)
+	start = common.time()
+	maker.prepare([goal], maat.io.Monitor())
+	duration = common.time() - start
+	print("%8d nodes: %s (%d jobs, %.2fus/node)" % (size,
+		common.format_duration(duration), len(maker.jobs),
+		duration * 1000000 / size))
+
+
+if __name__ == '__main__':
+	sizes = [int(a) for a in sys.argv[1:]]
+	if not sizes:
+		sizes = [10000, 100000]
+	for size in sizes:
+		bench(size)
@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+#
+#	MAAT benchmark of the rule database memory
+#	Copyright (C) 2022 H. Casse <hug.casse@gmail.com>
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark of the memory used by the rule database on synthetic
+graphs, compared with the former representation of rules (instances
+with a __dict__ holding lists of non-shared path strings).
+Usage: memory.py [SIZE...] (default sizes: 10000 100000)."""
+
+import os.path
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+import maat.rule
+
+
+class LegacyRule:
+	"""Rule as represented before the compact representation."""
+
+	def __init__(self, targets, sources, fun):
+		self.targets = targets
+		self.sources = sources
+		self.file = None
+		self.line = None
+		self.stem = None
+		self.depfile = None
+		self.fun = fun
+
+
+class LegacyDataBase:
+	"""Rule database as represented before the compact representation."""
+
+	def __init__(self):
+		self.rules = []
+		self.map = {}
+
+	def add(self, rule):
+		self.rules.append(rule)
+		for target in rule.targets:
+			self.map[target] = rule
+
+
+def action(rule):
+	pass
+
+
+def make_graph(db, cls, size, fanin = 4, seed = 0):
+	"""Fill the database with size rules, as generated by a script
+	building objects: rule i makes dir/file.o from the source file.c,
+	a header and fanin random previous objects. The paths are built
+	at each use as a script computing them would do."""
+	rand = random.Random(seed)
+	def path(i, ext):
+		return "src/dir%d/file%d%s" % (i // 100, i, ext)
+	for i in range(size):
+		sources = [path(i, ".c"), path(i // 10, ".h")]
+		for j in range(fanin if i else 0):
+			sources.append(path(rand.randrange(i), ".o"))
+		rule = cls([path(i, ".o")], sources, action)
+		rule.file = "make.maat"
+		rule.line = 1
+		db.add(rule)
+
+
+def measure(db, cls, size):
+	"""Measure the memory allocated to build the graph."""
+	tracemalloc.start()
+	make_graph(db, cls, size)
+	current, _ = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	return current
+
+
+def bench(size):
+	before = measure(LegacyDataBase(), LegacyRule, size)
+	after = measure(maat.rule.DataBase(), maat.rule.FunRule, size)
+	print("%8d rules: legacy %.1f MB (%d B/rule), compact %.1f MB (%d B/rule), %.0f%% saved"
+		% (size, before / 1e6, before // size, after / 1e6, after // size,
+		(before - after) * 100 / before))
+
+
+if __name__ == '__main__':
+	sizes = [int(a) for a in sys.argv[1:]]
+	if not sizes:
+		sizes = [10000, 100000]
+	for size in sizes:
+		bench(size)